@@ -6,6 +6,8 @@ Turn the gitenv into RPM spec files which can be built at a later stage.
 from __future__ import print_function
 
 from fnmatch import fnmatch
+import hashlib
+from multiprocessing import cpu_count
 import os
 import shutil
 
@@ -17,12 +19,29 @@ from conda_gitenv.deploy import tags_by_label
 from conda_gitenv.resolve import tempdir, create_tracking_branches
 from git import Repo
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 import logging
 import conda_rpms.generate as generate
 import conda_rpms.install as conda_install
 
 
+#: The maximum number of packages to download concurrently.
+FETCH_WORKERS = 8
+
+#: The maximum number of package specs to render concurrently.
+RENDER_WORKERS = cpu_count()
+
+#: Marks a key which is absent from a configuration file.
+_MISSING = object()
+
+#: Parsed configuration files, keyed on their path and modification time.
+_configs = {}
+
+
 class Config(dict):
     def __init__(self, fname, store=None, key=None):
         self.fname = os.path.abspath(os.path.expanduser(fname))
@@ -32,14 +51,20 @@ class Config(dict):
         self._key = []
         if key is not None:
             self._key = key
+        # Wrapped child sections, created on first access.
+        self._children = {}
 
     def _load(self):
         if not os.path.exists(self.fname):
             emsg = 'The configuration file {!r} does not exist.'
             raise ValueError(emsg.format(os.path.basename(self.fname)))
+        key = (self.fname, os.path.getmtime(self.fname))
+        if key in _configs:
+            self._store = _configs[key]
+            return
         with open(self.fname, 'r') as fh:
             try:
-                self._store = yaml.safe_load(fh)
+                self._store = _configs[key] = yaml.load(fh, Loader=SafeLoader)
             except yaml.YAMLError as e:
                 emsg = 'YAML error in configuration file {!r}: {}'
                 line, column = e.problem_mark.line, e.problem_mark.column
@@ -50,15 +75,18 @@ class Config(dict):
                                              ymsg))
 
     def __getitem__(self, key):
-        try:
-            result = self._store[key]
-        except KeyError:
+        result = self._store.get(key, _MISSING)
+        if result is _MISSING:
             emsg = 'The YAML file {!r} does not contain key [{}].'
             full_key = ']['.join(self._key + [key])
             raise ValueError(emsg.format(os.path.basename(self.fname),
                                          full_key))
         if isinstance(result, dict):
-            result = Config(self.fname, result, self._key + [key])
+            child = self._children.get(key)
+            if child is None:
+                child = Config(self.fname, result, self._key + [key])
+                self._children[key] = child
+            result = child
         return result
 
     def __contains__(self, key):
@@ -74,19 +102,19 @@ class Config(dict):
         return repr(self._store)
 
 
-def create_rpmbuild_for_env(pkgs, target, config):
+def create_rpmbuild_for_env(pkgs, target, config, index=None):
     rpm_prefix = config['rpm']['prefix']
     pkg_cache = os.path.join(target, 'SOURCES')
     pkg_names = set(pkg for _, pkg in pkgs)
 
-    if os.path.exists(target):
+    if os.path.isdir(target):
         # The environment we want to deploy already exists. We should
         # just double check that there aren't already packages in there which
         # we need to remove before we install anything new.
         linked = conda_install.linked(target)
-        for pkg in linked:
-            if pkg not in pkg_names:
-                conda_install.unlink(target, pkg)
+        stale = set(linked) - pkg_names
+        if stale:
+            conda_install.unlink_many(target, sorted(stale))
     else:
         linked = []
 
@@ -97,31 +125,124 @@ def create_rpmbuild_for_env(pkgs, target, config):
         return
 
     spec_dir = os.path.join(target, 'SPECS')
-    if not os.path.exists(spec_dir):
-        os.makedirs(spec_dir)
-
+    conda_install._makedirs(spec_dir)
+
+    # The channel index of each source, so that each channel is only
+    # fetched once no matter how many packages come from it.
+    index_cache = {}
+    if index is not None:
+        # Bucket the given (multi-channel) index by channel URL. Any source
+        # that isn't covered by the index is fetched on demand.
+        for pkg_info in index.values():
+            channel = pkg_info.get('channel', '').rstrip('/')
+            index_cache.setdefault(channel, {})[pkg_info['fn']] = pkg_info
+
+    # List the package cache and the specs directory once up front, rather
+    # than checking for the files of each package in turn.
+    fetched = conda_install.fetched(pkg_cache)
+    existing_specs = set(os.listdir(spec_dir))
+
+    to_fetch = []
     for source, pkg in pkgs:
-        index = conda.fetch.fetch_index([source], use_cache=False)
-        pkg_index = {pkg_info['fn']: pkg_info for pkg_info in index.values()}
+        pkg_index = index_cache.get(source.rstrip('/'))
+        if pkg_index is None:
+            channel_index = conda.fetch.fetch_index([source], use_cache=False)
+            pkg_index = {pkg_info['fn']: pkg_info
+                         for pkg_info in channel_index.values()}
+            index_cache[source.rstrip('/')] = pkg_index
         tar_name = pkg + '.tar.bz2'
         pkg_info = pkg_index.get(tar_name, None)
         if pkg_info is None:
             raise ValueError('Distribution {} is no longer available '
                              'in the channel {}.'.format(tar_name, source))
-        if not conda_install.is_fetched(pkg_cache, pkg):
+        if pkg not in fetched:
             print('Fetching {}'.format(pkg))
-            conda.fetch.fetch_pkg(pkg_info, pkg_cache)
-        spec_path = os.path.join(spec_dir, '{}-pkg-{}.spec'.format(rpm_prefix,
-                                                                   pkg))
-        if not os.path.exists(spec_path):
-            spec = generate.render_dist_spec(os.path.join(pkg_cache,
-                                                          tar_name), config)
-            with open(spec_path, 'w') as fh:
-                fh.write(spec)
+            to_fetch.append(pkg_info)
+            fetched.add(pkg)
+
+    # The downloads are independent of one another, so run them
+    # concurrently.
+    conda_install._parallel_map(
+        lambda pkg_info: conda.fetch.fetch_pkg(pkg_info, pkg_cache),
+        to_fetch, FETCH_WORKERS)
+
+    to_render = []
+    for _, pkg in pkgs:
+        spec_name = '{}-pkg-{}.spec'.format(rpm_prefix, pkg)
+        if spec_name not in existing_specs:
+            to_render.append((pkg, spec_name))
+            existing_specs.add(spec_name)
+
+    def render(job):
+        pkg, spec_name = job
+        spec = generate.render_dist_spec(os.path.join(pkg_cache,
+                                                      pkg + '.tar.bz2'),
+                                         config)
+        with open(os.path.join(spec_dir, spec_name), 'w') as fh:
+            fh.write(spec)
+
+    # Rendering is dominated by the decompression of each package, which
+    # releases the GIL, so the specs are rendered concurrently too.
+    conda_install._parallel_map(render, to_render, RENDER_WORKERS)
+
+
+def _tag_file(repo, tag_name, fname):
+    """
+    Return the content of the named file in the given tag, or None if the
+    tag doesn't have such a file. The working tree is left untouched.
+
+    """
+    tree = repo.tags[tag_name].commit.tree
+    try:
+        blob = tree[fname]
+    except KeyError:
+        return None
+    return blob.data_stream.read().decode('utf-8')
+
+
+def _is_dependency_ordered(pkgs, index):
+    """
+    Determine whether every one of the packages comes after all of its
+    dependencies which are also within the packages, in which case the
+    packages may be installed in the given order.
+
+    """
+    infos = dict((info.get('fn'), info) for info in index.values())
+    pkg_infos = []
+    for pkg in pkgs:
+        info = infos.get(pkg + '.tar.bz2')
+        if info is None:
+            # Without the package metadata the order cannot be checked.
+            return False
+        pkg_infos.append(info)
+    names = set(info['name'] for info in pkg_infos)
+    installed = set()
+    for info in pkg_infos:
+        for depend in info.get('depends', []):
+            name = depend.split()[0]
+            if name in names and name not in installed:
+                return False
+        installed.add(info['name'])
+    return True
+
+
+def _tag_hash(manifest_text, env_spec_text, config):
+    """
+    Return the hash of everything that goes into the spec of a tagged
+    environment: the content of the tag, the prefixes and the template.
+
+    """
+    template = os.path.join(generate.template_dir, 'taggedenv.spec.template')
+    with open(template, 'r') as fh:
+        template_text = fh.read()
+    content = '\0'.join([manifest_text, env_spec_text,
+                          config['rpm']['prefix'],
+                          config['install']['prefix'], template_text])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
 
 
 def create_rpmbuild_for_tag(repo, tag_name, target, config,
-                            api_user=None, api_key=None):
+                            api_user=None, api_key=None, index_cache=None):
     try:
         # Python3...
         from urllib.parse import urlparse
@@ -130,58 +251,80 @@ def create_rpmbuild_for_tag(repo, tag_name, target, config,
         from urlparse import urlparse
 
     rpm_prefix = config['rpm']['prefix']
-    print("CREATE FOR {}".format(tag_name))
-    tag = repo.tags[tag_name]
-    # Checkout the tag in a detached head form.
-    repo.head.reference = tag.commit
-    repo.head.reset(working_tree=True)
-
-    manifest_fname = os.path.join(repo.working_dir, 'env.manifest')
-    if not os.path.exists(manifest_fname):
+    env_name, env_tag = tag_name.split('-', 2)[1:]
+    fname = '{}-env-{}-tag-{}.spec'.format(rpm_prefix, env_name, env_tag)
+    spec_path = os.path.join(target, 'SPECS', fname)
+
+    # Read the files of the tag straight from the repository, rather than
+    # checking out its working tree.
+    manifest_text = _tag_file(repo, tag_name, 'env.manifest')
+    if manifest_text is None:
         emsg = "The tag '{}' doesn't have a manifested environment."
         raise ValueError(emsg.format(tag_name))
-    with open(manifest_fname, 'r') as fh:
-        manifest = sorted(line.strip().split('\t') for line in fh)
-        if api_user and api_key:
-            # Inject the API user and key into the channel URLs...
-            for i, (url, _) in enumerate(manifest):
-                parts = urlparse(url)
-                api_url = '{}://{}:{}@{}{}'.format(parts.scheme, api_user,
-                                                   api_key, parts.netloc,
-                                                   parts.path)
-                manifest[i][0] = api_url
-
-    create_rpmbuild_for_env(manifest, target, config)
-
-    index = conda.fetch.fetch_index(list(set([url for url, _ in manifest])),
-                                    use_cache=False)
-    resolver = Resolve(index)
-
-    # To sort, the distributions must match the format of the keys of the index
-    # For example, most will look like `http://channel::pkg
-    # However channels on anaconda go by their name rather than their url,
-    # i.e. `conda-forge::pkg`
-    dists = []
-    for url, pkg in manifest:
-        anaconda_url = 'https://conda.anaconda.org/'
-        if url.startswith(anaconda_url):
-            url = url[len(anaconda_url):]
-        dists.append('::'.join([os.path.dirname(url), pkg]))
-    sorted_dists = resolver.dependency_sort(dists)
-    sorted_pkgs = [dist.split('::')[-1] for dist in sorted_dists]
-
-    spec_fname = os.path.join(repo.working_dir, 'env.spec')
-    if not os.path.exists(spec_fname):
+    env_spec_text = _tag_file(repo, tag_name, 'env.spec')
+    if env_spec_text is None:
         emsg = "The tag '{}' doesn't have an environment specification."
         raise ValueError(emsg.format(tag_name))
-    with open(spec_fname, 'r') as fh:
-        env_spec = yaml.safe_load(fh).get('env', [])
 
-    env_name, tag = tag_name.split('-', 2)[1:]
-    fname = '{}-env-{}-tag-{}.spec'.format(rpm_prefix, env_name, tag)
-    with open(os.path.join(target, 'SPECS', fname), 'w') as fh:
-        fh.write(generate.render_taggedenv(env_name, tag, sorted_pkgs, config,
-                                           env_spec))
+    # The tagged environment spec records the hash of what it was created
+    # from. If that is unchanged there is nothing to do.
+    hash_path = spec_path + '.hash'
+    tag_hash = _tag_hash(manifest_text, env_spec_text, config)
+    if os.path.exists(spec_path) and os.path.exists(hash_path):
+        with open(hash_path, 'r') as fh:
+            if fh.read().strip() == tag_hash:
+                print("UP TO DATE {}".format(tag_name))
+                return
+
+    print("CREATE FOR {}".format(tag_name))
+    manifest = sorted(line.strip().split('\t', 1)
+                      for line in manifest_text.splitlines() if line.strip())
+    if api_user and api_key:
+        # Inject the API user and key into the channel URLs...
+        for i, (url, _) in enumerate(manifest):
+            parts = urlparse(url)
+            api_url = '{}://{}:{}@{}{}'.format(parts.scheme, api_user,
+                                               api_key, parts.netloc,
+                                               parts.path)
+            manifest[i][0] = api_url
+
+    # Fetch the index of all of the channels in one go. This single index
+    # serves both the package specs and the dependency sort, and is shared
+    # with any other tags that use the same channels.
+    if index_cache is None:
+        index_cache = {}
+    urls = tuple(sorted(set(url for url, _ in manifest)))
+    index = index_cache.get(urls)
+    if index is None:
+        index = conda.fetch.fetch_index(list(urls), use_cache=False)
+        index_cache[urls] = index
+
+    create_rpmbuild_for_env(manifest, target, config, index=index)
+
+    sorted_pkgs = [pkg for _, pkg in manifest]
+    if not _is_dependency_ordered(sorted_pkgs, index):
+        resolver = Resolve(index)
+
+        # To sort, the distributions must match the format of the keys of the
+        # index. For example, most will look like `http://channel::pkg
+        # However channels on anaconda go by their name rather than their
+        # url, i.e. `conda-forge::pkg`
+        dists = []
+        for url, pkg in manifest:
+            anaconda_url = 'https://conda.anaconda.org/'
+            if url.startswith(anaconda_url):
+                url = url[len(anaconda_url):]
+            dists.append('::'.join([os.path.dirname(url), pkg]))
+        sorted_dists = resolver.dependency_sort(dists)
+        sorted_pkgs = [dist.split('::')[-1] for dist in sorted_dists]
+
+    env_spec = yaml.load(env_spec_text, Loader=SafeLoader).get('env', [])
+
+    with open(spec_path, 'w') as fh:
+        fh.write(generate.render_taggedenv(env_name, env_tag, sorted_pkgs,
+                                           config, env_spec))
+    with open(hash_path, 'w') as fh:
+        fh.write(tag_hash)
 
 
 def _env_label_filter(branch_name, label, env_labels):
@@ -190,8 +333,12 @@ def _env_label_filter(branch_name, label, env_labels):
     the desired environment labels.
 
     """
+    # The default pattern matches everything.
+    if '*' in env_labels:
+        return True
     item = '{}/{}'.format(branch_name, label)
-    return any([fnmatch(item, env_label) for env_label in env_labels])
+    # fnmatch keeps its own cache of the compiled patterns.
+    return any(fnmatch(item, env_label) for env_label in env_labels)
 
 
 def create_rpmbuild_content(repo, target, config, state, env_labels=None,
@@ -201,13 +348,16 @@ def create_rpmbuild_content(repo, target, config, state, env_labels=None,
 
     rpm_prefix = config['rpm']['prefix']
 
-    for branch in repo.branches:
+    branches = list(repo.branches)
+    branch_names = set(branch.name for branch in branches)
+
+    for branch in branches:
         # We only want environment branches, not manifest branches.
         if not branch.name.startswith(manifest_branch_prefix):
             manifest_branch_name = manifest_branch_prefix + branch.name
             # If there is no equivalent manifest branch, we need to
             # skip this environment.
-            if manifest_branch_name not in repo.branches:
+            if manifest_branch_name not in branch_names:
                 continue
             branch.checkout()
             fname = os.path.join(repo.working_dir, 'labels')
@@ -215,7 +365,10 @@ def create_rpmbuild_content(repo, target, config, state, env_labels=None,
 
             # Get the number of commits in this branch, and use this as the
             # version number in the environment label RPM spec.
-            commit_num = branch.commit.count()
+            # The count is made by git itself, rather than walking the
+            # history one commit object at a time.
+            commit_num = int(repo.git.rev_list('--count',
+                                               branch.commit.hexsha))
 
             # Determine the environment tags that are new or have been changed
             # for each branch label, and thus require to have its associated
@@ -236,6 +389,10 @@ def create_rpmbuild_content(repo, target, config, state, env_labels=None,
                 # labels for RPM building.
                 labelled_tags = branch_labelled_tags
 
+            # The channel indices fetched for this branch, which are
+            # typically common to all of its labelled tags.
+            index_cache = {}
+
             # Keep track of the labels which have tags - its those we want.
             for label, tag in sorted(labelled_tags.items()):
                 # Only create RPMs for environments that match the given
@@ -243,7 +400,8 @@ def create_rpmbuild_content(repo, target, config, state, env_labels=None,
                 if _env_label_filter(branch.name, label, env_labels):
                     create_rpmbuild_for_tag(repo, tag, target, config,
                                             api_user=api_user,
-                                            api_key=api_key)
+                                            api_key=api_key,
+                                            index_cache=index_cache)
                     fname = '{}-env-{}-label-{}.spec'.format(
                             rpm_prefix, branch.name, label)
                     with open(os.path.join(target, 'SPECS', fname), 'w') as fh:
@@ -272,8 +430,7 @@ def create_rpm_installer(target, config, python_spec='python'):
     shutil.copyfile(installer_source, installer_target)
 
     spec_dir = os.path.join(target, 'SPECS')
-    if not os.path.exists(spec_dir):
-        os.makedirs(spec_dir)
+    conda_install._makedirs(spec_dir)
 
     specfile = os.path.join(spec_dir, '{}-installer.spec'.format(rpm_prefix))
     with open(specfile, 'w') as fh:
@@ -307,11 +464,20 @@ def handle_args(args):
         logger.setLevel(logging.WARNING)
 
     config = Config(args.config)
+    # Check the prefixes needed by every spec before doing any work, rather
+    # than failing part way through the build of the RPM structure.
+    for section in ('rpm', 'install'):
+        if (section not in config or
+                not isinstance(config[section], dict) or
+                'prefix' not in config[section]):
+            emsg = 'The configuration file {!r} is missing {}.prefix.'
+            raise ValueError(emsg.format(os.path.basename(config.fname),
+                                         section))
     state = {}
     if args.state is not None:
         fname = os.path.abspath(os.path.expanduser(args.state))
         with open(fname, 'r') as fi:
-            state = yaml.safe_load(fi) or {}
+            state = yaml.load(fi, Loader=SafeLoader) or {}
     with tempdir() as repo_directory:
         repo = Repo.clone_from(args.repo_uri, repo_directory)
         create_tracking_branches(repo)
@@ -5,44 +5,151 @@ import jinja2
 template_dir = os.path.join(os.path.dirname(__file__), 'templates')
 loader = jinja2.FileSystemLoader(template_dir)
 
-env = jinja2.Environment(loader=loader)
-env_trim_blocks = jinja2.Environment(loader=loader, trim_blocks=True)
+# Compiled templates are kept in jinja's on-disk bytecode cache between runs.
+# Each environment has its own cache file pattern, as the compiled code
+# depends upon the environment's options.
+env = jinja2.Environment(
+    loader=loader,
+    bytecode_cache=jinja2.FileSystemBytecodeCache(
+        pattern='__conda_rpms_%s.cache'))
+env_trim_blocks = jinja2.Environment(
+    loader=loader, trim_blocks=True,
+    bytecode_cache=jinja2.FileSystemBytecodeCache(
+        pattern='__conda_rpms_trim_blocks_%s.cache'))
 
-pkg_spec_tmpl = env.get_template('pkg.spec.template')
-env_spec_tmpl = env_trim_blocks.get_template('env.spec.template')
-taggedenv_spec_tmpl = env.get_template('taggedenv.spec.template')
-installer_spec_tmpl = env.get_template('installer.spec.template')
+_templates = {}
 
+
+def _template(name, trim_blocks=False):
+    """Return the named template, which is only loaded on first use."""
+    key = (name, trim_blocks)
+    template = _templates.get(key)
+    if template is None:
+        environment = env_trim_blocks if trim_blocks else env
+        template = _templates[key] = environment.get_template(name)
+    return template
+
+
+import hashlib
 import json
 import re
 import tarfile
+import tempfile
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
-TAG_PATTERN = '^env-\w+-(\d{4}_\d{2}_\d{2}(-\d+)?)$'
+import conda_rpms.install as conda_install
+
+# The environment name cannot contain a hyphen, so the match is linear in
+# the length of the tag.
+TAG_PATTERN = r'^env-\w+-(\d{4}_\d{2}_\d{2}(-\d+)?)$'
 tag_pattern = re.compile(TAG_PATTERN)
 # Parse out the environment name from the default (.verison) modulefile.
 # e.g "set modulesversion 'default-current'"
-ENV_PATTERN = '^\s*set\s+modulesversion\s+[\'\"](.*)[\'\"]\s*$'
-env_pattern = re.compile(ENV_PATTERN, re.IGNORECASE)
+ENV_PATTERN = r'^\s*set\s+modulesversion\s+[\'\"](.*)[\'\"]\s*$'
+env_pattern = re.compile(ENV_PATTERN, re.IGNORECASE | re.MULTILINE)
+
+
+def _spec_cache_path(dist, config, rpm_prefix, install_prefix):
+    """
+    Return the path of the cached spec of the given distribution, or None
+    if no spec cache has been configured.
+
+    """
+    if 'cache' not in config:
+        return None
+    cache_dir = os.path.expanduser(config['cache']['dir'])
+    # The rendered spec depends upon the configured prefixes as well as
+    # upon the (uniquely named) distribution.
+    key = '{}\n{}'.format(rpm_prefix, install_prefix)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    name = os.path.basename(dist)
+    if name.endswith('.tar.bz2'):
+        name = name[:-len('.tar.bz2')]
+    return os.path.join(cache_dir, 'specs', digest, name + '.spec')
+
+
+def _read_cached_spec(cache_path, dist):
+    """
+    Return the cached spec, provided it is newer than both the distribution
+    and the package spec template, otherwise None.
+
+    """
+    template = os.path.join(template_dir, 'pkg.spec.template')
+    try:
+        cache_mtime = os.path.getmtime(cache_path)
+        if cache_mtime < max(os.path.getmtime(dist),
+                             os.path.getmtime(template)):
+            return None
+        with open(cache_path, 'r') as fh:
+            return fh.read()
+    except (IOError, OSError):
+        return None
+
+
+def _write_cached_spec(cache_path, spec):
+    dname = os.path.dirname(cache_path)
+    conda_install._makedirs(dname)
+    # Write to a temporary file and rename it into place, so that
+    # concurrent builds never see a partially written spec.
+    fd, tmp_path = tempfile.mkstemp(dir=dname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(spec)
+        os.rename(tmp_path, cache_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
 
 
 def render_dist_spec(dist, config):
+    """
+    Render the package spec of the given conda distribution.
+
+    When the configuration contains a "cache" directory, rendered specs are
+    kept there and re-used by subsequent renders of the same distribution.
+
+    """
+    rpm_prefix = config['rpm']['prefix']
+    install_prefix = config['install']['prefix']
+    cache_path = _spec_cache_path(dist, config, rpm_prefix, install_prefix)
+    if cache_path is not None:
+        spec = _read_cached_spec(cache_path, dist)
+        if spec is not None:
+            return spec
+    spec = _render_dist_spec(dist, rpm_prefix, install_prefix)
+    if cache_path is not None:
+        _write_cached_spec(cache_path, spec)
+    return spec
+
+
+def _render_dist_spec(dist, rpm_prefix, install_prefix):
     with tarfile.open(dist, 'r:bz2') as tar:
-        m = tar.getmember('info/index.json')
-        fh = tar.extractfile(m)
+        # Find the metadata members in a single pass over the archive,
+        # stopping as soon as both have been seen.
+        wanted = ('info/index.json', 'info/recipe.json')
+        members = {}
+        for m in tar:
+            if m.name in wanted:
+                members[m.name] = m
+                if len(members) == len(wanted):
+                    break
+        if 'info/index.json' not in members:
+            raise KeyError("filename 'info/index.json' not found")
+
         import codecs
 
         reader = codecs.getreader("utf-8")
+        fh = tar.extractfile(members['info/index.json'])
         pkginfo = json.load(reader(fh))
 
-        try:
-            m = tar.getmember('info/recipe.json')
-        except KeyError:
-            m = None
-
+        m = members.get('info/recipe.json')
         if m:
             fh = tar.extractfile(m)
-            meta = yaml.safe_load(reader(fh))
+            meta = yaml.load(reader(fh), Loader=SafeLoader)
         else:
             meta = {}
 
@@ -50,13 +157,42 @@ def render_dist_spec(dist, config):
     meta_about.setdefault('license', pkginfo.get('license'))
     meta_about.setdefault('summary', 'The {} package'.format(pkginfo['name']))
 
-    rpm_prefix = config['rpm']['prefix']
-    install_prefix = config['install']['prefix']
+    template = _template('pkg.spec.template')
+    return template.render(pkginfo=pkginfo,
+                           meta=meta,
+                           rpm_prefix=rpm_prefix,
+                           install_prefix=install_prefix)
+
+
+_module_templates = {}
+
+
+def _module_template(fname):
+    """Return the modulefile template, which is only loaded on first use."""
+    template = _module_templates.get(fname)
+    if template is None:
+        module_loader = jinja2.FileSystemLoader(os.path.dirname(fname))
+        module_env = jinja2.Environment(loader=module_loader)
+        template = module_env.get_template(os.path.basename(fname))
+        _module_templates[fname] = template
+    return template
+
+
+_default_modulefiles = {}
+
 
-    return pkg_spec_tmpl.render(pkginfo=pkginfo,
-                                meta=meta,
-                                rpm_prefix=rpm_prefix,
-                                install_prefix=install_prefix)
+def _read_default_modulefile(fname):
+    """
+    Return the content of the default modulefile, which is only re-read when
+    the file has been modified.
+
+    """
+    key = (fname, os.path.getmtime(fname))
+    default = _default_modulefiles.get(key)
+    if default is None:
+        with open(fname, 'r') as fi:
+            default = _default_modulefiles[key] = fi.read()
+    return default
 
 
 def render_env(branch_name, label, config, tag, commit_num):
@@ -78,28 +214,22 @@ def render_env(branch_name, label, config, tag, commit_num):
         module['prefix'] = config['module']['prefix']
         # The module file must exist (the modulefile for the tagged envs).
         fname = config['module']['file']
-        module_loader = jinja2.FileSystemLoader(os.path.dirname(fname))
-        module_env = jinja2.Environment(loader=module_loader)
-        module_template = module_env.get_template(os.path.basename(fname))
+        module_template = _module_template(fname)
         module['file'] = module_template.render(env=env_info)
         module['default'] = None
         # Configure the optional default modulefile, which provides the
         # name of the default environment and label e.g. "default-current".
         if 'default' in config['module']:
-            with open(config['module']['default'], 'r') as fi:
-                lines = fi.readlines()
-            for line in lines:
-                match = env_pattern.match(line)
-                if match:
-                    module_name, module_label = match.group(1).split('-', 2)
-                    module['name'] = module_name
-                    module['label'] = module_label
-                    break
-            else:
+            default = _read_default_modulefile(config['module']['default'])
+            match = env_pattern.search(default)
+            if match is None:
                 emsg = ('Cannot find environment name/label within default '
                         'modulefile "{}".')
                 raise ValueError(emsg.format(config['module']['default']))
-            module['default'] = ''.join(lines)
+            module_name, module_label = match.group(1).split('-', 2)
+            module['name'] = module_name
+            module['label'] = module_label
+            module['default'] = default
 
     # When multiple tags are produced in a day, they have an associated count
     # addded to the end e.g. env-default-2016_12_05-2, which needs to be parsed
@@ -111,8 +241,9 @@ def render_env(branch_name, label, config, tag, commit_num):
               "'env-<environment name>-YYYY-MM-DD(-<count> (optional))'"
         raise ValueError(msg.format(tag))
     tag_name = match.group(1)
-    spec = env_spec_tmpl.render(rpm_prefix=rpm_prefix, env=env_info,
-                                module=module, labelled_tag=tag_name)
+    template = _template('env.spec.template', trim_blocks=True)
+    spec = template.render(rpm_prefix=rpm_prefix, env=env_info,
+                           module=module, labelled_tag=tag_name)
     return spec
 
 
@@ -125,18 +256,20 @@ def render_taggedenv(env_name, tag, pkgs, config, env_spec):
                 'spec': '\n'.join(env_spec)}
     rpm_prefix = config['rpm']['prefix']
     install_prefix = config['install']['prefix']
-    return taggedenv_spec_tmpl.render(install_prefix=install_prefix,
-                                      pkgs=pkgs,
-                                      rpm_prefix=rpm_prefix,
-                                      env=env_info)
+    template = _template('taggedenv.spec.template')
+    return template.render(install_prefix=install_prefix,
+                           pkgs=pkgs,
+                           rpm_prefix=rpm_prefix,
+                           env=env_info)
 
 
 def render_installer(pkg_info, config):
     rpm_prefix = config['rpm']['prefix']
     install_prefix = config['install']['prefix']
-    return installer_spec_tmpl.render(install_prefix=install_prefix,
-                                      rpm_prefix=rpm_prefix,
-                                      pkg_info=pkg_info)
+    template = _template('installer.spec.template')
+    return template.render(install_prefix=install_prefix,
+                           rpm_prefix=rpm_prefix,
+                           pkg_info=pkg_info)
 
 
 if __name__ == '__main__':
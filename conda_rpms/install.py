@@ -38,24 +38,43 @@ standalone, i.e. not import any other parts of `conda` (only depend on
 the standard library).
 '''
 
+import errno
+import functools
+import io
 import json
 import logging
+import mmap
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import os
 from os.path import abspath, basename, dirname, exists, isdir, isfile, islink, \
     join, lexists, split, splitext
 import re
-import shlex
 import shutil
 import stat
 from stat import S_IMODE, S_IXGRP, S_IXOTH, S_IXUSR
 import subprocess
 import sys
-import tarfile
 from textwrap import dedent
+import threading
 import time
 import traceback
 import warnings
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 try:
     from conda.lock import Locked
@@ -131,6 +150,39 @@ link_name_map = {
     LINK_COPY: 'copy',
 }
 
+# The buffer size used to copy files where the kernel cannot copy them.
+COPY_BUFSIZE = 2 * 1024 * 1024
+
+def _copy_file(src, dst):
+    """
+    Copy the file src to dst, along with its permission bits and times as
+    shutil.copy2 does, letting the kernel copy the content where possible.
+    """
+    # Never write through an existing destination, which may be a hard link
+    # to another package's file.
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    with open(src, 'rb') as fsrc:
+        with io.open(os.open(dst, flags, 0o666), 'wb') as fdst:
+            copied = False
+            if hasattr(os, 'sendfile'):
+                try:
+                    size = os.fstat(fsrc.fileno()).st_size
+                    offset = 0
+                    while offset < size:
+                        sent = os.sendfile(fdst.fileno(), fsrc.fileno(),
+                                           offset, size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+                    copied = True
+                except OSError:
+                    # sendfile is not supported for these files.
+                    fdst.seek(0)
+                    fdst.truncate()
+            if not copied:
+                shutil.copyfileobj(fsrc, fdst, COPY_BUFSIZE)
+    shutil.copystat(src, dst)
+
 def _link(src, dst, linktype=LINK_HARD):
     if linktype == LINK_HARD:
         if on_win:
@@ -147,11 +199,23 @@ def _link(src, dst, linktype=LINK_HARD):
         if not on_win and islink(src) and not os.readlink(src).startswith('/'):
             os.symlink(os.readlink(src), dst)
         else:
-            shutil.copy2(src, dst)
+            _copy_file(src, dst)
     else:
         raise Exception("Did not expect linktype=%r" % linktype)
 
 
+def _makedirs(path):
+    """
+    Create the directory path and any missing parents, unless the directory
+    already exists.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not isdir(path):
+            raise
+
+
 def _remove_readonly(func, path, excinfo):
     os.chmod(path, stat.S_IWRITE)
     func(path)
@@ -199,19 +263,24 @@ def rm_empty_dir(path):
     """
     Remove the directory `path` if it is a directory and empty.
     If the directory does not exist or is not empty, do nothing.
+    Return False if something was left in place at `path`.
     """
     try:
         os.rmdir(path)
-    except OSError: # directory might not exist or not be empty
-        pass
+    except OSError as e: # directory might not exist or not be empty
+        return e.errno == errno.ENOENT
+    return True
 
 
-def yield_lines(path):
-    for line in open(path):
-        line = line.strip()
-        if not line or line.startswith('#'):
-            continue
-        yield line
+def read_lines(path):
+    """
+    Return the stripped lines of the file at path, skipping blank lines
+    and comments.
+    """
+    with open(path) as fi:
+        lines = fi.read().split('\n')
+    return [line for line in (line.strip() for line in lines)
+            if line and not line.startswith('#')]
 
 
 prefix_placeholder = ('/opt/anaconda1anaconda2'
@@ -225,9 +294,11 @@ def read_has_prefix(path):
     reads `has_prefix` file and return dict mapping filenames to
     tuples(placeholder, mode)
     """
+    import shlex
+
     res = {}
     try:
-        for line in yield_lines(path):
+        for line in read_lines(path):
             try:
                 placeholder, mode, f = [x.strip('"\'') for x in
                                         shlex.split(line, posix=False)]
@@ -247,19 +318,52 @@ def binary_replace(data, a, b):
     replaced with `b` and the remaining string is padded with null characters.
     All input arguments are expected to be bytes objects.
     """
-    import re
-
-    def replace(match):
-        occurances = match.group().count(a)
-        padding = (len(a) - len(b))*occurances
-        if padding < 0:
-            raise PaddingError(a, b, padding)
-        return match.group().replace(a, b) + b'\0' * padding
-    pat = re.compile(re.escape(a) + b'([^\0]*?)\0')
-    res = pat.sub(replace, data)
+    # Only null terminated strings are replaced, so the final chunk (which
+    # has no terminating null) is always left untouched.
+    chunks = data.split(b'\0')
+    for i in range(len(chunks) - 1):
+        chunk = chunks[i]
+        if a in chunk:
+            padding = (len(a) - len(b)) * chunk.count(a)
+            if padding < 0:
+                raise PaddingError(a, b, padding)
+            chunks[i] = chunk.replace(a, b) + b'\0' * padding
+    res = b'\0'.join(chunks)
     assert len(res) == len(data)
     return res
 
+def binary_replace_file(path, a, b):
+    """
+    Perform the binary replacement of `binary_replace` in place on the file
+    at `path`, without reading the whole file into memory. Every replacement
+    is checked before any is made, so the file is left untouched on a
+    PaddingError.
+    """
+    with open(path, 'r+b') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return
+        mm = mmap.mmap(fh.fileno(), 0)
+        try:
+            edits = []
+            start = mm.find(a)
+            while start != -1:
+                end = mm.find(b'\0', start)
+                if end == -1:
+                    # The trailing string is not null terminated.
+                    break
+                region = mm[start:end]
+                padding = (len(a) - len(b)) * region.count(a)
+                if padding < 0:
+                    raise PaddingError(a, b, padding)
+                edits.append((start, region.replace(a, b) + b'\0' * padding))
+                start = mm.find(a, end + 1)
+            for start, new in edits:
+                mm[start:start + len(new)] = new
+            if edits:
+                mm.flush()
+        finally:
+            mm.close()
+
 def update_prefix(path, new_prefix, placeholder=prefix_placeholder,
                   mode='text'):
     if on_win and (placeholder != prefix_placeholder) and ('/' in placeholder):
@@ -267,45 +371,80 @@ def update_prefix(path, new_prefix, placeholder=prefix_placeholder,
         # replace with unix-style path separators
         new_prefix = new_prefix.replace('\\', '/')
 
-    path = os.path.realpath(path)
-    with open(path, 'rb') as fi:
-        data = fi.read()
-    if mode == 'text':
-        new_data = data.replace(placeholder.encode('utf-8'),
-                                new_prefix.encode('utf-8'))
-    elif mode == 'binary':
-        new_data = binary_replace(data, placeholder.encode('utf-8'),
-                                  new_prefix.encode('utf-8'))
-    else:
+    # Opening the file follows any symlinks, so the path need not be
+    # resolved first.
+    if mode == 'binary':
+        binary_replace_file(path, placeholder.encode('utf-8'),
+                            new_prefix.encode('utf-8'))
+        return
+    elif mode != 'text':
         sys.exit("Invalid mode:" % mode)
 
-    if new_data == data:
-        return
-    st = os.lstat(path)
-    with open(path, 'wb') as fo:
-        fo.write(new_data)
-    os.chmod(path, stat.S_IMODE(st.st_mode))
+    placeholder_bytes = placeholder.encode('utf-8')
+    with open(path, 'r+b') as fh:
+        data = fh.read()
+        if placeholder_bytes not in data:
+            return
+        new_data = data.replace(placeholder_bytes, new_prefix.encode('utf-8'))
+        if new_data == data:
+            return
+        st = os.fstat(fh.fileno())
+        fh.seek(0)
+        fh.write(new_data)
+        fh.truncate()
+        fh.flush()
+        # Restore any setuid/setgid bits cleared by the write.
+        if hasattr(os, 'fchmod'):
+            os.fchmod(fh.fileno(), stat.S_IMODE(st.st_mode))
+        else:
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+
+
+def _loads(data):
+    """
+    Parse the JSON encoded bytes, with orjson when it is available.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
+
+
+# Write the conda-meta records as sorted and indented JSON, rather than as
+# compact JSON, for tools which read them line by line.
+PRETTY_META = bool(os.environ.get('CONDA_RPMS_PRETTY_META'))
+
+
+def _dumps(obj):
+    """
+    Return obj as JSON encoded bytes, with orjson when it is available.
+    """
+    if orjson is not None:
+        option = 0
+        if PRETTY_META:
+            option = orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    if PRETTY_META:
+        return json.dumps(obj, indent=2, sort_keys=True).encode('utf-8')
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
 
 
 def name_dist(dist):
     return dist.rsplit('-', 2)[0]
 
 
-def create_meta(prefix, dist, info_dir, extra_info):
+def create_meta(prefix, dist, index_data, extra_info):
     """
-    Create the conda metadata, in a given prefix, for a given package.
+    Create the conda metadata, in a given prefix, for a given package, from
+    the package's parsed info/index.json.
     """
-    # read info/index.json first
-    with open(join(info_dir, 'index.json')) as fi:
-        meta = json.load(fi)
+    meta = dict(index_data)
     # add extra info
     meta.update(extra_info)
     # write into <env>/conda-meta/<dist>.json
     meta_dir = join(prefix, 'conda-meta')
-    if not isdir(meta_dir):
-        os.makedirs(meta_dir)
-    with open(join(meta_dir, dist + '.json'), 'w') as fo:
-        json.dump(meta, fo, indent=2, sort_keys=True)
+    _makedirs(meta_dir)
+    with open(join(meta_dir, dist + '.json'), 'wb') as fo:
+        fo.write(_dumps(meta))
 
 
 def mk_menus(prefix, files, remove=False):
@@ -347,7 +486,8 @@ def run_script(prefix, dist, action='post-link', env_prefix=None):
             return False
     else:
         args = ['/bin/bash', path]
-    env = os.environ
+    # Leave the environment of this process alone.
+    env = os.environ.copy()
     env['PREFIX'] = str(env_prefix or prefix)
     env['PKG_NAME'], env['PKG_VERSION'], env['PKG_BUILDNUM'] = \
                 str(dist).rsplit('-', 2)
@@ -386,7 +526,7 @@ def read_no_link(info_dir):
     res = set()
     for fn in 'no_link', 'no_softlink':
         try:
-            res.update(set(yield_lines(join(info_dir, fn))))
+            res.update(read_lines(join(info_dir, fn)))
         except IOError:
             pass
     return res
@@ -429,6 +569,9 @@ SHEBANG_REGEX = (br'^(#!'  # pretty much the whole match string
                  br'(/(?:\\ |[^ \n\r\t])*)'  # the executable is the next text block without an escaped space or non-space whitespace character  # NOQA
                  br'(.*)'  # the rest of the line can contain option flags
                  br')$')  # end whole_shebang group
+_SHEBANG_PAT = re.compile(SHEBANG_REGEX, re.MULTILINE)
+
+_PYTHON_DIST_PAT = re.compile(r'^python-(\d+.\d+)')
 
 
 def pyc_path(py_path, python_major_minor_version):
@@ -466,31 +609,42 @@ def get_python_noarch_target_path(source_short_path, target_site_packages_short_
         return source_short_path
 
 
-def compile_pyc(python_exe_full_path, py_full_path, pyc_full_path):
+def compile_pyc_batch(python_exe_full_path, py_full_paths,
+                      python_major_minor_version):
     """
-    Modified version of conda/gateways/disk/create.py:compile_pyc at
-    be8c08c083f4d5e05b06bd2689d2cd0d410c2ffe.
-
-    Modification included:
-        * changed log.trace -> log.info (log.trace not supported)
+    Compile the python files with a single python process, rather than with
+    a python process per file, and return the paths of the pyc files which
+    were successfully compiled.
 
     """
-    if os.path.lexists(pyc_full_path):
-        warnings.warn('{} already exists'.format(pyc_full_path))
-    command = [python_exe_full_path, '-Wi', '-m', 'py_compile', py_full_path]
-    subprocess.call(command)
-
-    if not isfile(pyc_full_path):
-        message = """
+    pyc_full_paths = [pyc_path(py_full_path, python_major_minor_version)
+                      for py_full_path in py_full_paths]
+    if not py_full_paths:
+        return []
+    for pyc_full_path in pyc_full_paths:
+        if os.path.lexists(pyc_full_path):
+            warnings.warn('{} already exists'.format(pyc_full_path))
+    # The files to compile are listed on stdin.
+    command = [python_exe_full_path, '-Wi', '-m', 'compileall', '-q',
+               '-i', '-']
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+    encoding = sys.getfilesystemencoding()
+    proc.communicate('\n'.join(py_full_paths).encode(encoding))
+
+    compiled = []
+    for py_full_path, pyc_full_path in zip(py_full_paths, pyc_full_paths):
+        if isfile(pyc_full_path):
+            compiled.append(pyc_full_path)
+        else:
+            message = """
                 pyc file failed to compile successfully
-                  python_exe_full_path: %()s\n
-                  py_full_path: %()s\n
-                  pyc_full_path: %()s\n
+                  python_exe_full_path: %s\n
+                  py_full_path: %s\n
+                  pyc_full_path: %s\n
                 """
-        log.info(message, python_exe_full_path, py_full_path, pyc_full_path)
-        return None
-
-    return pyc_full_path
+            log.info(message, python_exe_full_path, py_full_path,
+                     pyc_full_path)
+    return compiled
 
 
 def parse_entry_point_def(ep_definition):
@@ -533,7 +687,7 @@ def replace_long_shebang(data):
         * removed mode check for non-binary shebang
 
     """
-    shebang_match = re.match(SHEBANG_REGEX, data, re.MULTILINE)
+    shebang_match = _SHEBANG_PAT.match(data)
     if shebang_match:
         whole_shebang, executable, options = shebang_match.groups()
         if len(whole_shebang) > 127:
@@ -598,7 +752,7 @@ def get_python_version(prefix):
     """
     py_ver = None
     for dist in linked(prefix):
-        match = re.search('^python-(\d+.\d+)', dist)
+        match = _PYTHON_DIST_PAT.search(dist)
         if match:
             py_ver = match.group(1)
             break
@@ -627,6 +781,58 @@ def try_hard_link(pkgs_dir, prefix, dist):
         rm_rf(dst)
         rm_empty_dir(prefix)
 
+# ------- directory scans
+
+# The results of directory scans, keyed on the scan, the scanned directory
+# and its modification time.
+_scans = {}
+
+def _cached_scan(scan, path):
+    """
+    Return the result of scan(path), which is only re-run when the directory
+    has been modified or the cache has been invalidated. A directory which
+    does not exist scans as an empty set.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return set()
+    # The nanosecond time tells apart changes within the same second (from
+    # Python 3.3).
+    mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+    key = (scan, path, mtime)
+    result = _scans.get(key)
+    if result is None:
+        result = _scans[key] = frozenset(scan(path))
+    return set(result)
+
+def invalidate():
+    """
+    Forget the cached directory scans, after changing the packages in a
+    package cache or an environment.
+    """
+    _scans.clear()
+
+def _package_dirs(pkgs_dir):
+    """
+    Yield the name and path of each entry of the package cache which may be
+    an extracted package.
+    """
+    if scandir is None:
+        for dn in os.listdir(pkgs_dir):
+            yield dn, join(pkgs_dir, dn)
+        return
+    it = scandir(pkgs_dir)
+    try:
+        for entry in it:
+            # The entry type comes with the directory listing, so the
+            # tarballs are skipped without a stat.
+            if entry.is_dir():
+                yield entry.name, entry.path
+    finally:
+        if hasattr(it, 'close'):
+            it.close()
+
 # ------- package cache ----- fetched
 
 def fetched(pkgs_dir):
@@ -649,30 +855,133 @@ def extracted(pkgs_dir):
     """
     return the (set of canonical names) of all extracted packages
     """
+    # This is not cached, as the package cache directory is not modified
+    # when the info files appear within a package directory.
     if not isdir(pkgs_dir):
         return set()
-    return set(dn for dn in os.listdir(pkgs_dir)
-               if (isfile(join(pkgs_dir, dn, 'info', 'files')) and
-                   isfile(join(pkgs_dir, dn, 'info', 'index.json'))))
+    return set(dn for dn, path in _package_dirs(pkgs_dir)
+               if (isfile(join(path, 'info', 'files')) and
+                   isfile(join(path, 'info', 'index.json'))))
+
+# The buffer size used to read and decompress package tarballs.
+EXTRACT_BUFSIZE = 2 * 1024 * 1024
+
+class _ReadAhead(object):
+    """
+    A read-only file object that reads ahead of its consumer in a background
+    thread, so that the decompression of a package overlaps with the writing
+    of its extracted files.
+    """
+    def __init__(self, fileobj, chunksize=EXTRACT_BUFSIZE, depth=4):
+        self._queue = queue.Queue(depth)
+        self._buffer = b''
+        self._offset = 0
+        self._eof = False
+        self._closing = False
+        self._thread = threading.Thread(target=self._fill,
+                                        args=(fileobj, chunksize))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fill(self, fileobj, chunksize):
+        try:
+            while not self._closing:
+                chunk = fileobj.read(chunksize)
+                self._queue.put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            self._queue.put(e)
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0 and not self._eof:
+            if self._offset >= len(self._buffer):
+                item = self._queue.get()
+                if isinstance(item, Exception):
+                    raise item
+                if not item:
+                    self._eof = True
+                    break
+                self._buffer, self._offset = item, 0
+            end = len(self._buffer)
+            if size > 0:
+                end = min(end, self._offset + size)
+                size -= end - self._offset
+            pieces.append(self._buffer[self._offset:end])
+            self._offset = end
+        return b''.join(pieces)
+
+    def close(self):
+        # Unblock the reader thread, which may be waiting to queue a chunk.
+        self._closing = True
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+def _no_chown(*args, **kwargs):
+    pass
+
+def _tar_copyfileobj(src, dst, length=None, exception=IOError,
+                     bufsize=None):
+    """
+    A replacement for tarfile.copyfileobj which copies member content in
+    EXTRACT_BUFSIZE chunks, for the versions of tarfile which do not
+    support TarFile.copybufsize.
+    """
+    bufsize = bufsize or EXTRACT_BUFSIZE
+    if length == 0:
+        return
+    if length is None:
+        shutil.copyfileobj(src, dst, bufsize)
+        return
+    blocks, remainder = divmod(length, bufsize)
+    for size in [bufsize] * blocks + ([remainder] if remainder else []):
+        buf = src.read(size)
+        if len(buf) < size:
+            raise exception("unexpected end of data")
+        dst.write(buf)
 
 def extract(pkgs_dir, dist):
     """
     Extract a package, i.e. make a package available for linkage.  We assume
     that the compressed packages is located in the packages directory.
     """
+    import bz2
+    import tarfile
+
+    if sys.version_info < (3, 8):
+        # Widen the 16 KiB buffer used to copy member content.
+        tarfile.copyfileobj = _tar_copyfileobj
+
     with Locked(pkgs_dir):
         path = join(pkgs_dir, dist)
-        t = tarfile.open(path + '.tar.bz2')
-        t.extractall(path=path)
-        t.close()
-        if sys.platform.startswith('linux') and os.getuid() == 0:
-            # When extracting as root, tarfile will by restore ownership
-            # of extracted files.  However, we want root to be the owner
-            # (our implementation of --no-same-owner).
-            for root, dirs, files in os.walk(path):
-                for fn in files:
-                    p = join(root, fn)
-                    os.lchown(p, 0, 0)
+        with io.open(path + '.tar.bz2', 'rb',
+                     buffering=EXTRACT_BUFSIZE) as raw:
+            if sys.version_info[0] >= 3:
+                fileobj, mode = _ReadAhead(bz2.BZ2File(raw)), 'r|'
+            else:
+                # BZ2File cannot wrap a file object on Python 2.
+                fileobj, mode = raw, 'r|bz2'
+            try:
+                # Stream the members in a single pass, rather than seeking
+                # about the archive in small blocks.
+                with tarfile.open(fileobj=fileobj, mode=mode,
+                                  bufsize=EXTRACT_BUFSIZE) as t:
+                    # Copy the member content in large chunks (from
+                    # Python 3.8).
+                    t.copybufsize = EXTRACT_BUFSIZE
+                    # When extracting as root, tarfile would restore the
+                    # archived ownership of the extracted files. However, we
+                    # want root to be the owner (our implementation of
+                    # --no-same-owner), which it already is as their creator.
+                    t.chown = _no_chown
+                    t.extractall(path=path)
+            finally:
+                fileobj.close()
+        invalidate()
 
 def is_extracted(pkgs_dir, dist):
     return (isfile(join(pkgs_dir, dist, 'info', 'files')) and
@@ -682,6 +991,7 @@ def rm_extracted(pkgs_dir, dist):
     with Locked(pkgs_dir):
         path = join(pkgs_dir, dist)
         rm_rf(path)
+        invalidate()
 
 # ------- linkage of packages
 
@@ -689,10 +999,10 @@ def linked(prefix):
     """
     Return the (set of canonical names) of linked packages in prefix.
     """
-    meta_dir = join(prefix, 'conda-meta')
-    if not isdir(meta_dir):
-        return set()
-    return set(fn[:-5] for fn in os.listdir(meta_dir) if fn.endswith('.json'))
+    return _cached_scan(_scan_linked, join(prefix, 'conda-meta'))
+
+def _scan_linked(meta_dir):
+    return [fn[:-5] for fn in os.listdir(meta_dir) if fn.endswith('.json')]
 
 
 def is_linked(prefix, dist):
@@ -702,17 +1012,61 @@ def is_linked(prefix, dist):
     """
     meta_path = join(prefix, 'conda-meta', dist + '.json')
     try:
-        with open(meta_path) as fi:
-            return json.load(fi)
+        with open(meta_path, 'rb') as fi:
+            return _loads(fi.read())
     except IOError:
         return None
 
 
+# The number of threads used to link (or unlink) the files of a package. Set
+# the CONDA_RPMS_LINK_WORKERS environment variable to 1 to do so serially.
+LINK_WORKERS = int(os.environ.get('CONDA_RPMS_LINK_WORKERS',
+                                  min(32, cpu_count() * 4)))
+
+def _parallel_map(func, items, workers):
+    """
+    Apply func to each of the items using a pool of threads, and return the
+    results in order.
+    """
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def _noarch_type(index_data):
+    """
+    Return the noarch type of a package from its index data, or False if it
+    is not a noarch package.
+    """
+    noarch = False
+    if 'noarch' in index_data:
+        noarch = index_data['noarch']
+    elif 'noarch_python' in index_data:
+        # `noarch_python` has been deprecated.
+        if index_data['noarch_python'] is True:
+            noarch = 'python'
+    return noarch
+
 def link(pkgs_dir, prefix, dist, linktype=LINK_HARD, index=None, target_prefix=None):
     '''
     Set up a package in a specified (environment) prefix.  We assume that
     the package has been extracted (using extract() above).
     '''
+    with Locked(prefix), Locked(pkgs_dir):
+        _link_dist(pkgs_dir, prefix, dist, linktype, index, target_prefix,
+                   LINK_WORKERS)
+
+def _link_dist(pkgs_dir, prefix, dist, linktype, index, target_prefix,
+               workers):
+    """
+    Link a package into the prefix, with the prefix and the package cache
+    already locked by the caller, linking its files using the given number
+    of threads.
+    """
     if target_prefix is None:
         target_prefix = prefix
     index = index or {}
@@ -730,21 +1084,15 @@ def link(pkgs_dir, prefix, dist, linktype=LINK_HARD, index=None, target_prefix=N
         sys.exit('Error: pre-link failed: %s' % dist)
 
     info_dir = join(source_dir, 'info')
-    files = list(yield_lines(join(info_dir, 'files')))
+    files = read_lines(join(info_dir, 'files'))
     has_prefix_files = read_has_prefix(join(info_dir, 'has_prefix'))
     no_link = read_no_link(info_dir)
 
-    noarch = False
     # If the distribution is noarch, it will contain a `link.json` file in
     # the info_dir
-    with open(join(info_dir, 'index.json'), 'r') as fh:
-        index_data = json.loads(fh.read())
-    if 'noarch' in index_data:
-        noarch = index_data['noarch']
-    elif 'noarch_python' in index_data:
-        # `noarch_python` has been deprecated.
-        if index_data['noarch_python'] is True:
-            noarch = 'python'
+    with open(join(info_dir, 'index.json'), 'rb') as fh:
+        index_data = _loads(fh.read())
+    noarch = _noarch_type(index_data)
 
     if noarch == 'python':
         if on_win:
@@ -752,8 +1100,8 @@ def link(pkgs_dir, prefix, dist, linktype=LINK_HARD, index=None, target_prefix=N
 
         link_json = join(info_dir, 'link.json')
         if exists(link_json):
-            with open(link_json, 'r') as fh:
-                link_data = json.loads(fh.read())
+            with open(link_json, 'rb') as fh:
+                link_data = _loads(fh.read())
             if 'noarch' in link_data:
                 noarch_json = link_data['noarch']
 
@@ -767,220 +1115,350 @@ def link(pkgs_dir, prefix, dist, linktype=LINK_HARD, index=None, target_prefix=N
     # added to the metadata.
     all_files = []
 
-    with Locked(prefix), Locked(pkgs_dir):
-        for f in files:
-            src = join(source_dir, f)
-
-            if noarch == 'python':
-                noarch_f = get_python_noarch_target_path(f,
-                                                         target_site_packages)
-                dst = join(prefix, noarch_f)
-                all_files.append(noarch_f)
-            # Non-noarch packages do not need special handling of the
-            # site-packages
-            else:
-                dst = join(prefix, f)
-                all_files.append(f)
-
-            dst_dir = dirname(dst)
-            if not isdir(dst_dir):
-                os.makedirs(dst_dir)
-            if os.path.exists(dst):
+    dsts = []
+    for f in files:
+        if noarch == 'python':
+            noarch_f = get_python_noarch_target_path(f,
+                                                     target_site_packages)
+            dst = join(prefix, noarch_f)
+            all_files.append(noarch_f)
+        # Non-noarch packages do not need special handling of the
+        # site-packages
+        else:
+            dst = join(prefix, f)
+            all_files.append(f)
+        dsts.append(dst)
+
+    # Create the destination directories up front, so that the files
+    # may be linked concurrently without racing to create them.
+    for dst_dir in sorted(set(dirname(dst) for dst in dsts)):
+        _makedirs(dst_dir)
+
+    # The package cache pseudo-package keeps its placeholders.
+    replace_prefix = name_dist(dist) != '_cache'
+
+    def link_file(item):
+        f, dst = item
+        src = join(source_dir, f)
+        lt = linktype
+        if f in has_prefix_files or f in no_link or islink(src):
+            lt = LINK_COPY
+        try:
+            try:
+                _link(src, dst, lt)
+            except OSError as e:
+                # Only look at the destination when it is in the way.
+                if e.errno != errno.EEXIST:
+                    raise
                 log.warn("file already exists: %r" % dst)
                 try:
                     os.unlink(dst)
                 except OSError:
                     log.error('failed to unlink: %r' % dst)
-            lt = linktype
-            if f in has_prefix_files or f in no_link or islink(src):
-                lt = LINK_COPY
-            try:
                 _link(src, dst, lt)
-            except OSError as e:
-                log.error('failed to link (src=%r, dst=%r, type=%r, error=%r)' %
-                          (src, dst, lt, e))
-
-        # noarch package specific installation steps
-        if noarch == 'python':
-            # Create entrypoints
-            if 'entry_points' in noarch_json:
-                for entry_point in noarch_json['entry_points']:
-
-                    command, module, func = parse_entry_point_def(entry_point)
-                    entry_point_file = create_python_entry_point(
-                        join(prefix, 'bin', command),
-                        join(prefix, target_python_short_path), module, func)
-                    all_files.append(entry_point_file)
-
-            # Compile pyc files
-            for f in all_files:
-                if f.endswith('.py'):
-                    py_path = join(prefix, f)
-                    pyc_filepath = compile_pyc(
-                        join(prefix,
-                        target_python_short_path),
-                        py_path,
-                        pyc_path(py_path, target_py_version))
-                    if pyc_filepath.startswith(prefix):
-                        all_files.append(pyc_filepath[len(prefix):])
-
-        if name_dist(dist) == '_cache':
+        except OSError as e:
+            log.error('failed to link (src=%r, dst=%r, type=%r, error=%r)' %
+                      (src, dst, lt, e))
             return
-
-        for f in sorted(has_prefix_files):
+        # Replace the prefix while the freshly copied file is still
+        # in the page cache.
+        if replace_prefix and f in has_prefix_files:
             placeholder, mode = has_prefix_files[f]
-            try:
-                update_prefix(join(prefix, f), target_prefix, placeholder, mode)
-            except PaddingError:
-                sys.exit("ERROR: placeholder '%s' too short in: %s\n" %
-                         (placeholder, dist))
+            update_prefix(dst, target_prefix, placeholder, mode)
 
-        mk_menus(prefix, files, remove=False)
+    try:
+        _parallel_map(link_file, list(zip(files, dsts)), workers)
+    except PaddingError as e:
+        placeholder = e.args[0].decode('utf-8')
+        sys.exit("ERROR: placeholder '%s' too short in: %s\n" %
+                 (placeholder, dist))
 
-        if not run_script(prefix, dist, 'post-link', target_prefix):
-            sys.exit("Error: post-link failed for: %s" % dist)
+    # noarch package specific installation steps
+    if noarch == 'python':
+        # Create entrypoints
+        if 'entry_points' in noarch_json:
+            for entry_point in noarch_json['entry_points']:
+
+                command, module, func = parse_entry_point_def(entry_point)
+                entry_point_file = create_python_entry_point(
+                    join(prefix, 'bin', command),
+                    join(prefix, target_python_short_path), module, func)
+                all_files.append(entry_point_file)
+
+        # Compile pyc files
+        py_paths = [join(prefix, f) for f in all_files
+                    if f.endswith('.py')]
+        pyc_filepaths = compile_pyc_batch(
+            join(prefix, target_python_short_path),
+            py_paths,
+            target_py_version)
+        for pyc_filepath in pyc_filepaths:
+            if pyc_filepath.startswith(prefix):
+                all_files.append(pyc_filepath[len(prefix):])
+
+    if name_dist(dist) == '_cache':
+        return
 
-        # Make sure the script stays standalone for the installer
-        try:
-            from conda.config import remove_binstar_tokens
-        except ImportError:
-            # There won't be any binstar tokens in the installer anyway
-            def remove_binstar_tokens(url):
-                return url
+    mk_menus(prefix, files, remove=False)
 
-        meta_dict = index.get(dist + '.tar.bz2', {})
-        meta_dict['url'] = read_url(pkgs_dir, dist)
-        if meta_dict['url']:
-            meta_dict['url'] = remove_binstar_tokens(meta_dict['url'])
-        try:
-            alt_files_path = join(prefix, 'conda-meta', dist + '.files')
-            meta_dict['files'] = list(yield_lines(alt_files_path))
-            os.unlink(alt_files_path)
-        except IOError:
-            meta_dict['files'] = all_files
-        meta_dict['link'] = {'source': source_dir,
-                             'type': link_name_map.get(linktype)}
-        if 'channel' in meta_dict:
-            meta_dict['channel'] = remove_binstar_tokens(meta_dict['channel'])
-        if 'icon' in meta_dict:
-            meta_dict['icondata'] = read_icondata(source_dir)
+    if not run_script(prefix, dist, 'post-link', target_prefix):
+        sys.exit("Error: post-link failed for: %s" % dist)
+
+    # Make sure the script stays standalone for the installer
+    try:
+        from conda.config import remove_binstar_tokens
+    except ImportError:
+        # There won't be any binstar tokens in the installer anyway
+        def remove_binstar_tokens(url):
+            return url
+
+    meta_dict = index.get(dist + '.tar.bz2', {})
+    meta_dict['url'] = read_url(pkgs_dir, dist)
+    if meta_dict['url']:
+        meta_dict['url'] = remove_binstar_tokens(meta_dict['url'])
+    try:
+        alt_files_path = join(prefix, 'conda-meta', dist + '.files')
+        meta_dict['files'] = read_lines(alt_files_path)
+        os.unlink(alt_files_path)
+    except IOError:
+        meta_dict['files'] = all_files
+    meta_dict['link'] = {'source': source_dir,
+                         'type': link_name_map.get(linktype)}
+    if 'channel' in meta_dict:
+        meta_dict['channel'] = remove_binstar_tokens(meta_dict['channel'])
+    if 'icon' in meta_dict:
+        meta_dict['icondata'] = read_icondata(source_dir)
+
+    create_meta(prefix, dist, index_data, meta_dict)
+    invalidate()
+
+def link_all(pkgs_dir, prefix, dists, linktype=LINK_HARD, target_prefix=None,
+             verbose=False):
+    '''
+    Set up several extracted packages in the prefix, one at a time and in
+    the given order, so that a file shipped by more than one package comes
+    from the last of them, and each post-link script runs once the packages
+    before it are in place.
+    '''
+    # The link type has been decided once for all the packages.
+    link_dist = functools.partial(_link_dist, pkgs_dir, prefix,
+                                  linktype=linktype, index=None,
+                                  target_prefix=target_prefix,
+                                  workers=LINK_WORKERS)
+    with Locked(prefix), Locked(pkgs_dir):
+        for dist in dists:
+            if verbose:
+                print("linking: %s" % dist)
+            link_dist(dist)
 
-        create_meta(prefix, dist, info_dir, meta_dict)
+def _remove_file(dst):
+    try:
+        os.unlink(dst)
+    except OSError: # file might not exist
+        log.debug("could not remove file: '%s'" % dst)
 
 def unlink(prefix, dist):
     '''
     Remove a package from the specified environment, it is an error if the
     package does not exist in the prefix.
     '''
-    if (on_win and abspath(prefix) == abspath(sys.prefix) and
-              name_dist(dist) in win_ignore_root):
+    unlink_many(prefix, [dist])
+
+
+def unlink_many(prefix, dists):
+    '''
+    Remove several packages from the specified environment, under a single
+    lock and with a single sweep of the directories left empty. It is an
+    error if any of the packages does not exist in the prefix.
+    '''
+    if on_win and abspath(prefix) == abspath(sys.prefix):
         # on Windows we have the file lock problem, so don't allow
         # linking or unlinking some packages
-        log.warn('Ignored: %s' % dist)
+        for dist in dists:
+            if name_dist(dist) in win_ignore_root:
+                log.warn('Ignored: %s' % dist)
+        dists = [dist for dist in dists
+                 if name_dist(dist) not in win_ignore_root]
+
+    if not dists:
         return
 
     with Locked(prefix):
-        run_script(prefix, dist, 'pre-unlink')
+        meta_dir = join(prefix, 'conda-meta')
+        dst_dirs1 = set()
+
+        for dist in dists:
+            run_script(prefix, dist, 'pre-unlink')
 
-        meta_path = join(prefix, 'conda-meta', dist + '.json')
-        with open(meta_path) as fi:
-            meta = json.load(fi)
+            meta_path = join(meta_dir, dist + '.json')
+            with open(meta_path, 'rb') as fi:
+                meta = _loads(fi.read())
 
-        mk_menus(prefix, meta['files'], remove=True)
-        dst_dirs1 = set()
+            mk_menus(prefix, meta['files'], remove=True)
 
-        for f in meta['files']:
-            dst = join(prefix, f)
-            dst_dirs1.add(dirname(dst))
-            try:
-                os.unlink(dst)
-            except OSError: # file might not exist
-                log.debug("could not remove file: '%s'" % dst)
+            dsts = [join(prefix, f) for f in meta['files']]
+            dst_dirs1.update(dirname(dst) for dst in dsts)
+            _parallel_map(_remove_file, dsts, LINK_WORKERS)
 
-        # remove the meta-file last
-        os.unlink(meta_path)
+            # remove the meta-file last
+            os.unlink(meta_path)
 
         dst_dirs2 = set()
-        for path in dst_dirs1:
-            while len(path) > len(prefix):
-                dst_dirs2.add(path)
+
+        def ancestors(path):
+            # Stop at the first ancestor already seen, as the ones above it
+            # have been added too. set.update() adds each one as it is
+            # yielded, so the check also sees those of the current path.
+            while len(path) > len(prefix) and path not in dst_dirs2:
+                yield path
                 path = dirname(path)
+
+        for path in dst_dirs1:
+            dst_dirs2.update(ancestors(path))
         # in case there is nothing left
-        dst_dirs2.add(join(prefix, 'conda-meta'))
-        dst_dirs2.add(prefix)
+        dst_dirs2.update((meta_dir, prefix))
 
+        # The deepest directories go first. Once one of them is left in
+        # place, none of its ancestors can be empty, so don't try them.
+        not_empty = set()
         for path in sorted(dst_dirs2, key=len, reverse=True):
-            rm_empty_dir(path)
+            if path in not_empty or not rm_empty_dir(path):
+                not_empty.add(dirname(path))
+        invalidate()
 
 
 def messages(prefix):
     path = join(prefix, '.messages.txt')
     try:
-        with open(path) as fi:
-            sys.stdout.write(fi.read())
+        fi = open(path, 'rb')
     except IOError:
-        pass
-    finally:
-        rm_rf(path)
+        return
+    try:
+        with fi:
+            _write_stdout(fi)
+    except (IOError, OSError) as e:
+        # Keep the messages, rather than lose them.
+        log.warn('failed to write the messages in %r: %s' % (path, e))
+        return
+    rm_rf(path)
+
+def _write_stdout(fi):
+    """
+    Write the content of the binary file object fi to stdout.
+    """
+    # The messages bypass the buffer of sys.stdout, so write out whatever
+    # has been printed before them first.
+    sys.stdout.flush()
+    offset = 0
+    if hasattr(os, 'sendfile'):
+        try:
+            fd = sys.stdout.fileno()
+            size = os.fstat(fi.fileno()).st_size
+            while offset < size:
+                sent = os.sendfile(fd, fi.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except (OSError, ValueError):
+            # sendfile is not supported for this stdout, which may not
+            # even have a file descriptor.
+            pass
+    fi.seek(offset)
+    out = getattr(sys.stdout, 'buffer', None)
+    if out is not None:
+        shutil.copyfileobj(fi, out, COPY_BUFSIZE)
+        out.flush()
+    elif sys.version_info[0] < 3:
+        # The stdout of Python 2 takes bytes.
+        shutil.copyfileobj(fi, sys.stdout, COPY_BUFSIZE)
+    else:
+        # A text-only stdout, such as an io.StringIO, takes the decoded
+        # messages.
+        text = io.TextIOWrapper(fi)
+        try:
+            shutil.copyfileobj(text, sys.stdout, COPY_BUFSIZE)
+        finally:
+            text.detach()
+    sys.stdout.flush()
 
 # =========================== end API functions ==========================
 
-def main():
-    from pprint import pprint
-    from optparse import OptionParser
+_cli_parser = None
+
+def _parser():
+    """
+    Return the command line parser, building it on the first call.
+    """
+    global _cli_parser
+    if _cli_parser is None:
+        from argparse import ArgumentParser
+
+        p = ArgumentParser(
+            description="low-level conda install tool, by default extracts "
+                        "(if necessary) and links a TARBALL")
+
+        p.add_argument('tarball',
+                       nargs='?',
+                       metavar='TARBALL/NAME')
 
-    p = OptionParser(
-        usage="usage: %prog [options] [TARBALL/NAME]",
-        description="low-level conda install tool, by default extracts "
-                    "(if necessary) and links a TARBALL")
+        p.add_argument('-l', '--list',
+                       action="store_true",
+                       help="list all linked packages")
 
-    p.add_option('-l', '--list',
-                 action="store_true",
-                 help="list all linked packages")
+        p.add_argument('--extract',
+                       action="store_true",
+                       help="extract package in pkgs cache")
 
-    p.add_option('--extract',
-                 action="store_true",
-                 help="extract package in pkgs cache")
+        p.add_argument('--link',
+                       action="store_true",
+                       help="link a package")
 
-    p.add_option('--link',
-                 action="store_true",
-                 help="link a package")
+        p.add_argument('--unlink',
+                       action="store_true",
+                       help="unlink a package")
 
-    p.add_option('--unlink',
-                 action="store_true",
-                 help="unlink a package")
+        p.add_argument('--target-prefix',
+                       default=None,
+                       help="target prefix (defaults to prefix)")
 
-    p.add_option('--target-prefix',
-                 default=None,
-                 help="target prefix (defaults to prefix)")
+        p.add_argument('-p', '--prefix',
+                       action="store",
+                       default=sys.prefix,
+                       help="prefix (defaults to %(default)s)")
 
-    p.add_option('-p', '--prefix',
-                 action="store",
-                 default=sys.prefix,
-                 help="prefix (defaults to %default)")
+        p.add_argument('--pkgs-dir',
+                       action="store",
+                       default=join(sys.prefix, 'pkgs'),
+                       help="packages directory (defaults to %(default)s)")
 
-    p.add_option('--pkgs-dir',
-                 action="store",
-                 default=join(sys.prefix, 'pkgs'),
-                 help="packages directory (defaults to %default)")
+        p.add_argument('--link-all',
+                       action="store_true",
+                       help="link all extracted packages")
 
-    p.add_option('--link-all',
-                 action="store_true",
-                 help="link all extracted packages")
+        p.add_argument('-v', '--verbose',
+                       action="store_true")
 
-    p.add_option('-v', '--verbose',
-                 action="store_true")
+        _cli_parser = p
+    return _cli_parser
 
-    opts, args = p.parse_args()
+def main(argv=None):
+    """
+    Run the command line tool with the given arguments, which default to
+    those of the process. Logging is only configured for the latter, so
+    that a calling program keeps its own.
+    """
+    p = _parser()
+    opts = p.parse_args(argv)
 
-    logging.basicConfig()
+    if argv is None:
+        logging.basicConfig()
 
     if opts.list or opts.extract or opts.link_all:
-        if args:
+        if opts.tarball is not None:
             p.error('no arguments expected')
     else:
-        if len(args) == 1:
-            dist = basename(args[0])
+        if opts.tarball is not None:
+            dist = basename(opts.tarball)
             if dist.endswith('.tar.bz2'):
                 dist = dist[:-8]
         else:
@@ -994,7 +1472,8 @@ def main():
         print("prefix  : %r" % prefix)
 
     if opts.list:
-        pprint(sorted(linked(prefix)))
+        for name in sorted(linked(prefix)):
+            print(name)
 
     elif opts.link_all:
         dists = sorted(extracted(pkgs_dir))
@@ -1003,10 +1482,9 @@ def main():
                     LINK_COPY)
         if opts.verbose or linktype == LINK_COPY:
             print("linktype: %s" % link_name_map[linktype])
-        for dist in dists:
-            if opts.verbose or linktype == LINK_COPY:
-                print("linking: %s" % dist)
-            link(pkgs_dir, prefix, dist, linktype, target_prefix=target_prefix)
+        link_all(pkgs_dir, prefix, dists, linktype,
+                 target_prefix=target_prefix,
+                 verbose=opts.verbose or linktype == LINK_COPY)
         messages(prefix)
 
     elif opts.extract:
@@ -1020,4 +1498,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -67,7 +67,8 @@ class CommonTest(unittest.TestCase):
         finally:
             shutil.rmtree(dname)
 
-    def add_label(self, repo, branch, fname, tag, comment=None):
+    @staticmethod
+    def add_label(repo, branch, fname, tag, comment=None):
         """
         Create a label file in the specified repository branch
         "labels" directory, which contains the provided tag.
@@ -80,7 +81,7 @@ class CommonTest(unittest.TestCase):
         fpath = os.path.join(dname, fname)
         with open(fpath, 'w') as fo:
             fo.write(tag)
-        self.repo.index.add([fpath])
+        repo.index.add([fpath])
         if comment is None:
             comment = 'Add label {}'.format(fname)
-        self.repo.index.commit(comment)
+        repo.index.commit(comment)
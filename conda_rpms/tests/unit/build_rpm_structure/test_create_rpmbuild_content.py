@@ -1,3 +1,4 @@
+from mock import ANY, call
 import os
 import shutil
 import unittest
@@ -10,40 +11,51 @@ import conda_rpms.tests as tests
 
 
 class Test(tests.CommonTest):
-    def setUp(self):
-        name = 'conda_rpms_{}'.format(self._testMethodName)
-        self.repo = setup_samples.create_repo(name)
-        self.bname = 'default'
-        self.env_spec = """
-                        channels:
-                            - defaults
-                        env:
-                            - python
-                        """
+    @classmethod
+    def setUpClass(cls):
+        # The sample repository is only read by the tests, so build it once.
+        # The name is unique to this process, so that concurrent test runs
+        # do not share the repository.
+        name = 'conda_rpms_rpmbuild_content_{}'.format(os.getpid())
+        cls.repo = setup_samples.create_repo(name)
+        cls.bname = 'default'
+        cls.env_spec = """
+                       channels:
+                           - defaults
+                       env:
+                           - python
+                       """
         # Require to create a dummy manifest branch.
-        self.repo.create_head(manifest_branch_prefix + self.bname)
-        self.branch = setup_samples.add_env(self.repo, self.bname,
-                                            self.env_spec)
+        cls.repo.create_head(manifest_branch_prefix + cls.bname)
+        cls.branch = setup_samples.add_env(cls.repo, cls.bname, cls.env_spec)
+        cls.ctag = 'env-{}-2017_01_01'.format(cls.bname)
+        cls.add_label(cls.repo, cls.branch, 'current.txt', cls.ctag)
+        cls.ntag = 'env-{}-2017_02_02'.format(cls.bname)
+        cls.add_label(cls.repo, cls.branch, 'next.txt', cls.ntag)
+        # Count the history independently of the git rev-list call made by
+        # create_rpmbuild_content.
+        cls.count = len(list(cls.branch.commit.iter_parents())) + 1
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.repo.working_dir, ignore_errors=True)
+
+    def setUp(self):
         func = 'conda_rpms.build_rpm_structure.create_rpmbuild_for_tag'
         self.mock_create_tag = self.patch(func)
         func = 'conda_rpms.generate.render_env'
         self.mock_render_env = self.patch(func, return_value='dummy-env')
         self.config = dict(rpm=dict(prefix='prefix'))
-        self.ctag = 'env-{}-2017_01_01'.format(self.bname)
-        self.add_label(self.repo, self.branch, 'current.txt', self.ctag)
-        self.ntag = 'env-{}-2017_02_02'.format(self.bname)
-        self.add_label(self.repo, self.branch, 'next.txt', self.ntag)
-        self.count = self.branch.commit.count()
 
-    def tearDown(self):
-        if os.path.exists(self.repo.working_dir):
-            shutil.rmtree(self.repo.working_dir)
+    def _tag_call(self, dname, tag):
+        return call(self.repo, tag, dname, self.config, api_user=None,
+                    api_key=None, index_cache=ANY)
 
     def _check_full_build(self, dname, state):
         create_rpmbuild_content(self.repo, dname, self.config, state)
         self.assertEqual(self.mock_create_tag.call_count, 2)
-        expected = [((self.repo, self.ctag, dname, self.config),),
-                    ((self.repo, self.ntag, dname, self.config),)]
+        expected = [self._tag_call(dname, self.ctag),
+                    self._tag_call(dname, self.ntag)]
         self.assertEqual(self.mock_create_tag.call_args_list, expected)
         self.assertEqual(self.mock_render_env.call_count, 2)
         expected = [((self.bname, 'current', self.config, self.ctag,
@@ -79,7 +91,7 @@ class Test(tests.CommonTest):
             state = dict(default=dict(current=self.ctag))
             create_rpmbuild_content(self.repo, dname, self.config, state)
             self.assertEqual(self.mock_create_tag.call_count, 1)
-            expected = [((self.repo, self.ntag, dname, self.config),)]
+            expected = [self._tag_call(dname, self.ntag)]
             self.assertEqual(self.mock_create_tag.call_args_list, expected)
             self.assertEqual(self.mock_render_env.call_count, 1)
             expected = [((self.bname, 'next', self.config, self.ntag,
@@ -95,7 +107,7 @@ class Test(tests.CommonTest):
             state = dict(default=dict(next=self.ntag))
             create_rpmbuild_content(self.repo, dname, self.config, state)
             self.assertEqual(self.mock_create_tag.call_count, 1)
-            expected = [((self.repo, self.ctag, dname, self.config),)]
+            expected = [self._tag_call(dname, self.ctag)]
             self.assertEqual(self.mock_create_tag.call_args_list, expected)
             self.assertEqual(self.mock_render_env.call_count, 1)
             expected = [((self.bname, 'current', self.config, self.ctag,
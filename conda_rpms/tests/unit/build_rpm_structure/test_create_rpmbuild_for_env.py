@@ -12,7 +12,7 @@ class Test(tests.CommonTest):
                      ['url2', 'pkg2']]
         self.prefix = 'Prefix'
         self.config = dict(rpm=dict(prefix=self.prefix))
-        self.patch('conda_rpms.install.unlink')
+        self.patch('conda_rpms.install.unlink_many')
 
     def test_pkg_all_linked(self):
         func = 'conda_rpms.install.linked'
@@ -31,7 +31,7 @@ class Test(tests.CommonTest):
                 create_rpmbuild_for_env(self.pkgs, target, self.config)
 
     @patch('conda_rpms.generate.render_dist_spec', return_value='spec')
-    @patch('conda_rpms.install.is_fetched', return_value=True)
+    @patch('conda_rpms.install.fetched', return_value={'pkg1', 'pkg2'})
     @patch('conda.fetch.fetch_index',
            return_value={'dummy0': {'fn': 'pkg1.tar.bz2'},
                          'dummy1': {'fn': 'pkg2.tar.bz2'}})
@@ -45,14 +45,15 @@ class Test(tests.CommonTest):
                         call(['url2'], use_cache=False)]
             self.assertEqual(mindex.call_args_list, expected)
             srcs_dir = os.path.join(target, 'SOURCES')
-            expected = [call(srcs_dir, 'pkg1'),
-                        call(srcs_dir, 'pkg2')]
+            expected = [call(srcs_dir)]
             self.assertEqual(mfetched.call_args_list, expected)
+            # The specs are rendered concurrently, in any order.
             expected = [call(os.path.join(srcs_dir, 'pkg1.tar.bz2'),
                              self.config),
                         call(os.path.join(srcs_dir, 'pkg2.tar.bz2'),
                              self.config)]
-            self.assertEqual(mrender.call_args_list, expected)
+            self.assertEqual(mrender.call_count, 2)
+            mrender.assert_has_calls(expected, any_order=True)
             fname = '{}-pkg-{}.spec'
             specs = [os.path.join(spec_dir, fname.format(self.prefix, 'pkg1')),
                      os.path.join(spec_dir, fname.format(self.prefix, 'pkg2'))]
@@ -61,7 +62,7 @@ class Test(tests.CommonTest):
 
     @patch('conda_rpms.generate.render_dist_spec', return_value='spec')
     @patch('conda.fetch.fetch_pkg')
-    @patch('conda_rpms.install.is_fetched', return_value=False)
+    @patch('conda_rpms.install.fetched', return_value=set())
     @patch('conda.fetch.fetch_index',
            return_value={'dummy0': {'fn': 'pkg1.tar.bz2'},
                          'dummy1': {'fn': 'pkg2.tar.bz2'}})
@@ -75,23 +76,54 @@ class Test(tests.CommonTest):
                         call(['url2'], use_cache=False)]
             self.assertEqual(mindex.call_args_list, expected)
             srcs_dir = os.path.join(target, 'SOURCES')
-            expected = [call(srcs_dir, 'pkg1'),
-                        call(srcs_dir, 'pkg2')]
+            expected = [call(srcs_dir)]
             self.assertEqual(mfetched.call_args_list, expected)
+            # The packages are fetched concurrently, in any order.
             expected = [call({'fn': 'pkg1.tar.bz2'}, srcs_dir),
                         call({'fn': 'pkg2.tar.bz2'}, srcs_dir)]
-            self.assertEqual(mpkg.call_args_list, expected)
+            self.assertEqual(mpkg.call_count, 2)
+            mpkg.assert_has_calls(expected, any_order=True)
+            # The specs are rendered concurrently, in any order.
             expected = [call(os.path.join(srcs_dir, 'pkg1.tar.bz2'),
                              self.config),
                         call(os.path.join(srcs_dir, 'pkg2.tar.bz2'),
                              self.config)]
-            self.assertEqual(mrender.call_args_list, expected)
+            self.assertEqual(mrender.call_count, 2)
+            mrender.assert_has_calls(expected, any_order=True)
             fname = '{}-pkg-{}.spec'
             specs = [os.path.join(spec_dir, fname.format(self.prefix, 'pkg1')),
                      os.path.join(spec_dir, fname.format(self.prefix, 'pkg2'))]
             for spec in specs:
                 self.assertTrue(os.path.isfile(spec))
 
+    @patch('conda_rpms.generate.render_dist_spec', return_value='spec')
+    @patch('conda_rpms.install.fetched', return_value={'pkg1', 'pkg2'})
+    @patch('conda.fetch.fetch_index',
+           return_value={'dummy0': {'fn': 'pkg1.tar.bz2'},
+                         'dummy1': {'fn': 'pkg2.tar.bz2'}})
+    @patch('conda_rpms.install.linked', return_value=[])
+    def test_channel_fetched_once(self, mlinked, mindex, mfetched, mrender):
+        pkgs = [['url1', 'pkg1'],
+                ['url1', 'pkg2']]
+        with self.temp_dir() as target:
+            create_rpmbuild_for_env(pkgs, target, self.config)
+            expected = [call(['url1'], use_cache=False)]
+            self.assertEqual(mindex.call_args_list, expected)
+            self.assertEqual(mrender.call_count, 2)
+
+    @patch('conda_rpms.generate.render_dist_spec', return_value='spec')
+    @patch('conda_rpms.install.fetched', return_value={'pkg1', 'pkg2'})
+    @patch('conda.fetch.fetch_index', return_value={})
+    @patch('conda_rpms.install.linked', return_value=[])
+    def test_given_index(self, mlinked, mindex, mfetched, mrender):
+        index = {'dummy0': {'fn': 'pkg1.tar.bz2', 'channel': 'url1'},
+                 'dummy1': {'fn': 'pkg2.tar.bz2', 'channel': 'url2/'}}
+        with self.temp_dir() as target:
+            create_rpmbuild_for_env(self.pkgs, target, self.config,
+                                    index=index)
+            self.assertEqual(mindex.call_count, 0)
+            self.assertEqual(mrender.call_count, 2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,7 +2,8 @@ from mock import patch, MagicMock
 import os
 
 import conda_rpms.tests as tests
-from conda_rpms.build_rpm_structure import create_rpmbuild_for_tag
+from conda_rpms.build_rpm_structure import (create_rpmbuild_for_tag,
+                                            _tag_hash)
 
 
 CONFIG = {'rpm' : {'prefix' : 'SciTools'},
@@ -25,41 +26,112 @@ https://conda.anaconda.org/conda-forge/linux-64\tzlib-1.2.11-0
 """
 
 
+TAG_FILES = {'env.spec': ENV_SPEC, 'env.manifest': ENV_MANIFEST}
+
+
+def tag_file(repo, tag_name, fname):
+    return TAG_FILES.get(fname)
+
+
 class Test(tests.CommonTest):
+    @patch('conda_rpms.build_rpm_structure._tag_file', side_effect=tag_file)
     @patch('conda_rpms.build_rpm_structure.create_rpmbuild_for_env')
-    def test_sorted_order(self, a):
+    def test_sorted_order(self, a, b):
         with self.temp_dir() as target:
-            with self.temp_dir() as temp_repo:
-                # Create fake env.spec and manifest files
-                with open(os.path.join(temp_repo, 'env.spec'), 'w') as \
-                        env_spec_file:
-                    env_spec_file.write(ENV_SPEC)
-                with open(os.path.join(temp_repo, 'env.manifest'), 'w') as \
-                        env_manifest_file:
-                    env_manifest_file.write(ENV_MANIFEST)
-
-                # Set up arguments for call to create_rpmbuild_for_tag
-                repo = MagicMock()
-                repo.working_dir = temp_repo
-                tag_name = 'env-default-2018_03_26'
-                # Create directory that the spec file will be written to
-                os.mkdir(os.path.join(target, 'SPECS'))
-                create_rpmbuild_for_tag(repo, tag_name, target, CONFIG)
+            # Set up arguments for call to create_rpmbuild_for_tag. The
+            # env.spec and manifest files are provided by tag_file.
+            repo = MagicMock()
+            tag_name = 'env-default-2018_03_26'
+            # Create directory that the spec file will be written to
+            os.mkdir(os.path.join(target, 'SPECS'))
+            create_rpmbuild_for_tag(repo, tag_name, target, CONFIG)
 
             # Compare the written spec file with what we'd expect
             with open(os.path.join(target, 'SPECS',
                                    'SciTools-env-default-tag-2018_03_26.spec'),
                       'r') as fh:
-                result_order = []
-                for line in fh.readlines():
-                    # Parse the lines of the spec file that are formatted as
-                    # `  {INSTALL} xz-5.2.3-0\n`
-                    line = line.strip()
-                    if line.startswith('${INSTALL}'):
-                        result_order.append(line.split(' ')[1])
+                # Parse the lines of the spec file that are formatted as
+                # `  {INSTALL} xz-5.2.3-0\n`
+                result_order = [line.split(None, 2)[1] for line in fh
+                                if line.lstrip().startswith('${INSTALL}')]
 
             expected_order = ['ca-certificates-2018.1.18-0', 'ncurses-5.9-10',
                               'tk-8.6.7-0', 'xz-5.2.3-0', 'zlib-1.2.11-0',
                               'openssl-1.0.2n-0', 'sqlite-3.20.1-2',
                               'python-3.6.4-0']
-            self.assertEqual(expected_order,result_order)
\ No newline at end of file
+            self.assertEqual(expected_order,result_order)
+
+    def _write_spec(self, target, config):
+        spec_dir = os.path.join(target, 'SPECS')
+        os.mkdir(spec_dir)
+        fname = os.path.join(spec_dir,
+                             'SciTools-env-default-tag-2018_03_26.spec')
+        with open(fname, 'w') as fh:
+            fh.write('spec')
+        with open(fname + '.hash', 'w') as fh:
+            fh.write(_tag_hash(ENV_MANIFEST, ENV_SPEC, config))
+        return fname
+
+    @patch('conda_rpms.build_rpm_structure._tag_file', side_effect=tag_file)
+    @patch('conda_rpms.build_rpm_structure.create_rpmbuild_for_env')
+    def test_unchanged_tag(self, mcreate_env, mtag_file):
+        with self.temp_dir() as target:
+            fname = self._write_spec(target, CONFIG)
+            repo = MagicMock()
+            create_rpmbuild_for_tag(repo, 'env-default-2018_03_26', target,
+                                    CONFIG)
+            # The spec has not been touched.
+            self.assertFalse(mcreate_env.called)
+            with open(fname, 'r') as fh:
+                self.assertEqual(fh.read(), 'spec')
+
+    def test_hash_covers_prefixes(self):
+        config = {'rpm': {'prefix': 'Other'},
+                  'install': {'prefix': 'test_install_location'}}
+        self.assertNotEqual(_tag_hash(ENV_MANIFEST, ENV_SPEC, CONFIG),
+                            _tag_hash(ENV_MANIFEST, ENV_SPEC, config))
+        config = {'rpm': {'prefix': 'SciTools'},
+                  'install': {'prefix': 'other_install_location'}}
+        self.assertNotEqual(_tag_hash(ENV_MANIFEST, ENV_SPEC, CONFIG),
+                            _tag_hash(ENV_MANIFEST, ENV_SPEC, config))
+
+    @patch('conda_rpms.build_rpm_structure._tag_file', side_effect=tag_file)
+    @patch('conda_rpms.build_rpm_structure.create_rpmbuild_for_env')
+    def test_changed_install_prefix(self, mcreate_env, mtag_file):
+        config = {'rpm': {'prefix': 'SciTools'},
+                  'install': {'prefix': 'old_install_location'}}
+        with self.temp_dir() as target:
+            self._write_spec(target, config)
+            # The spec is out of date, so the channel index gets fetched,
+            # which stops the build here.
+            self.patch('conda.fetch.fetch_index', side_effect=RuntimeError)
+            with self.assertRaises(RuntimeError):
+                create_rpmbuild_for_tag(MagicMock(), 'env-default-2018_03_26',
+                                        target, CONFIG)
+
+    @patch('conda_rpms.build_rpm_structure.Resolve')
+    @patch('conda.fetch.fetch_index',
+           return_value={'k0': {'fn': 'a-1-0.tar.bz2', 'name': 'a',
+                                'depends': []},
+                         'k1': {'fn': 'b-1-0.tar.bz2', 'name': 'b',
+                                'depends': ['a 1*', 'c']}})
+    @patch('conda_rpms.build_rpm_structure.create_rpmbuild_for_env')
+    def test_ordered_manifest(self, mcreate_env, mindex, mresolve):
+        files = {'env.spec': ENV_SPEC,
+                 'env.manifest': 'url\tb-1-0\nurl\ta-1-0\n'}
+        fname = 'conda_rpms.build_rpm_structure._tag_file'
+        with patch(fname, side_effect=lambda r, t, f: files.get(f)):
+            with self.temp_dir() as target:
+                os.mkdir(os.path.join(target, 'SPECS'))
+                create_rpmbuild_for_tag(MagicMock(), 'env-default-2018_03_26',
+                                        target, CONFIG)
+                spec = os.path.join(target, 'SPECS',
+                                    'SciTools-env-default-tag-2018_03_26.spec')
+                with open(spec, 'r') as fh:
+                    result_order = [line.split(' ')[1] for line in
+                                    (line.strip() for line in fh)
+                                    if line.startswith('${INSTALL}')]
+        # The manifest order already satisfies the dependencies, so no
+        # dependency sort is needed.
+        self.assertFalse(mresolve.called)
+        self.assertEqual(result_order, ['a-1-0', 'b-1-0'])
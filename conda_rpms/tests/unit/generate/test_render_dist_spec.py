@@ -0,0 +1,55 @@
+import io
+import json
+import os
+import tarfile
+import unittest
+
+import conda_rpms.tests as tests
+from conda_rpms.generate import render_dist_spec
+
+
+INDEX = {'name': 'foo', 'version': '1.0', 'build': '0', 'license': 'BSD'}
+
+
+class Test(tests.CommonTest):
+    def setUp(self):
+        self.config = {'install': {'prefix': '/data/local'},
+                       'rpm': {'prefix': 'Tools'}}
+
+    def create_dist(self, dname):
+        dist = os.path.join(dname, 'foo-1.0-0.tar.bz2')
+        data = json.dumps(INDEX).encode('utf-8')
+        with tarfile.open(dist, 'w:bz2') as tar:
+            info = tarfile.TarInfo('info/index.json')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        return dist
+
+    def test_render(self):
+        with self.temp_dir() as dname:
+            spec = render_dist_spec(self.create_dist(dname), self.config)
+        self.assertIn('Name:           Tools-pkg-foo-1.0-0', spec)
+        self.assertIn('License:        BSD', spec)
+
+    def test_cache(self):
+        with self.temp_dir() as dname:
+            dist = self.create_dist(dname)
+            self.config['cache'] = {'dir': os.path.join(dname, 'cache')}
+            spec = render_dist_spec(dist, self.config)
+            # The second render must come from the cache.
+            mopen = self.patch('tarfile.open')
+            self.assertEqual(render_dist_spec(dist, self.config), spec)
+            self.assertEqual(mopen.call_count, 0)
+
+    def test_cache_prefix_mismatch(self):
+        with self.temp_dir() as dname:
+            dist = self.create_dist(dname)
+            self.config['cache'] = {'dir': os.path.join(dname, 'cache')}
+            render_dist_spec(dist, self.config)
+            self.config['rpm']['prefix'] = 'Other'
+            spec = render_dist_spec(dist, self.config)
+        self.assertIn('Name:           Other-pkg-foo-1.0-0', spec)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
+import os
 import unittest
 
 from conda_rpms.generate import render_env
+import conda_rpms.tests as tests
 
 
 class Test_tag(unittest.TestCase):
@@ -33,5 +35,47 @@ class Test_tag(unittest.TestCase):
         with self.assertRaisesRegexp(ValueError, msg):
             self.check(tag='env-defa-ult-2016_12_15-2')
 
+    def test_long_bad_tag(self):
+        # A long near miss must be rejected without backtracking.
+        msg = "Cannot create an environment for the tag"
+        with self.assertRaisesRegexp(ValueError, msg):
+            self.check(tag='env-{}-2016_12_15-x'.format('2016_12_15' * 5000))
+
+
+class Test_module_default(tests.CommonTest):
+    def render(self, default):
+        with self.temp_dir() as dname:
+            modulefile = os.path.join(dname, 'modulefile')
+            with open(modulefile, 'w') as fh:
+                fh.write('#%Module1.0\n')
+            fname = os.path.join(dname, '.version')
+            with open(fname, 'w') as fh:
+                fh.write(default)
+            config = {'install': {'prefix': '/data/local'},
+                      'rpm': {'prefix': 'Tools'},
+                      'module': {'prefix': '/data/modules',
+                                 'file': modulefile,
+                                 'default': fname}}
+            return render_env(branch_name='default', label='current',
+                              config=config, tag='env-default-2016_12_15',
+                              commit_num=30)
+
+    def test_default(self):
+        default = '#%Module1.0\n\nset ModulesVersion "default-current"\n'
+        spec = self.render(default)
+        self.assertIn('/data/modules/.version', spec)
+        self.assertIn(default, spec)
+
+    def test_other_default(self):
+        default = '#%Module1.0\nset ModulesVersion "default-next"\n'
+        spec = self.render(default)
+        self.assertNotIn(default, spec)
+
+    def test_no_default(self):
+        msg = 'Cannot find environment name/label within default modulefile'
+        with self.assertRaisesRegexp(ValueError, msg):
+            self.render('#%Module1.0\n')
+
+
 if __name__ == '__main__':
     unittest.main()
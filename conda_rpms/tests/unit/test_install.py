@@ -0,0 +1,513 @@
+import errno
+import io
+import json
+import os
+import re
+import sys
+import tarfile
+import unittest
+
+from conda_rpms.install import (_copy_file, _ReadAhead, _tar_copyfileobj,
+                                binary_replace, binary_replace_file,
+                                compile_pyc_batch, extract, extracted,
+                                is_extracted, link_all, linked, LINK_COPY,
+                                main, messages, PaddingError, pyc_path,
+                                unlink_many, update_prefix)
+import conda_rpms.tests as tests
+
+
+PLACEHOLDER = b'/opt/placeholder_prefix_long_enough'
+
+
+def reference_binary_replace(data, a, b):
+    # The original regular expression based replacement, which the faster
+    # implementations must agree with.
+    def replace(match):
+        occurances = match.group().count(a)
+        padding = (len(a) - len(b)) * occurances
+        if padding < 0:
+            raise PaddingError(a, b, padding)
+        return match.group().replace(a, b) + b'\0' * padding
+    pat = re.compile(re.escape(a) + b'([^\0]*?)\0')
+    return pat.sub(replace, data)
+
+
+SAMPLES = [
+    # A single null terminated string.
+    b'head\0' + PLACEHOLDER + b'/lib\0tail',
+    # Several matches within the one string.
+    b'\0' + PLACEHOLDER + b'/lib:' + PLACEHOLDER + b'/lib64\0\0',
+    # Several strings, and text before the placeholder.
+    (b'x' * 10 + b'\0path=' + PLACEHOLDER + b'/bin\0' + PLACEHOLDER +
+     b'\0\0' + PLACEHOLDER + b'/share\0'),
+    # A trailing string which is not null terminated is left alone.
+    b'\0' + PLACEHOLDER + b'/etc\0' + PLACEHOLDER + b'/unterminated',
+    # No placeholder at all.
+    b'\0nothing to see here\0',
+]
+
+
+class Test_binary_replace(unittest.TestCase):
+    def test_reference(self):
+        new = b'/short'
+        for data in SAMPLES:
+            result = binary_replace(data, PLACEHOLDER, new)
+            self.assertEqual(result,
+                             reference_binary_replace(data, PLACEHOLDER, new))
+            self.assertEqual(len(result), len(data))
+
+    def test_null_padding(self):
+        data = b'\0' + PLACEHOLDER + b'/lib\0'
+        result = binary_replace(data, PLACEHOLDER, b'/new')
+        padding = b'\0' * (len(PLACEHOLDER) - len(b'/new'))
+        self.assertEqual(result, b'\0/new/lib' + padding + b'\0')
+
+    def test_padding_error(self):
+        data = b'\0' + PLACEHOLDER + b'\0'
+        with self.assertRaises(PaddingError):
+            binary_replace(data, PLACEHOLDER, PLACEHOLDER + b'/longer')
+
+
+class Test_binary_replace_file(tests.CommonTest):
+    def check(self, data, new):
+        with self.temp_dir() as dname:
+            fname = os.path.join(dname, 'binary')
+            with open(fname, 'wb') as fh:
+                fh.write(data)
+            binary_replace_file(fname, PLACEHOLDER, new)
+            with open(fname, 'rb') as fh:
+                return fh.read()
+
+    def test_reference(self):
+        new = b'/short'
+        for data in SAMPLES:
+            self.assertEqual(self.check(data, new),
+                             reference_binary_replace(data, PLACEHOLDER, new))
+
+    def test_empty(self):
+        self.assertEqual(self.check(b'', b'/short'), b'')
+
+    def test_padding_error_leaves_file(self):
+        # The new prefix is longer than the placeholder.
+        new = PLACEHOLDER + b'/x'
+        data = (b'\0' + PLACEHOLDER + b'/a\0' +
+                PLACEHOLDER + b'/b:' + PLACEHOLDER + b'/c\0')
+        with self.temp_dir() as dname:
+            fname = os.path.join(dname, 'binary')
+            with open(fname, 'wb') as fh:
+                fh.write(data)
+            with self.assertRaises(PaddingError):
+                binary_replace_file(fname, PLACEHOLDER, new)
+            with open(fname, 'rb') as fh:
+                self.assertEqual(fh.read(), data)
+
+
+class Test_update_prefix(tests.CommonTest):
+    def test_text(self):
+        placeholder = PLACEHOLDER.decode('utf-8')
+        with self.temp_dir() as dname:
+            fname = os.path.join(dname, 'script')
+            with open(fname, 'wb') as fh:
+                fh.write(b'#!' + PLACEHOLDER + b'/bin/python\n' +
+                         PLACEHOLDER + b'\n')
+            os.chmod(fname, 0o755)
+            update_prefix(fname, '/new', placeholder, mode='text')
+            with open(fname, 'rb') as fh:
+                self.assertEqual(fh.read(), b'#!/new/bin/python\n/new\n')
+            self.assertEqual(os.stat(fname).st_mode & 0o777, 0o755)
+
+    def test_binary(self):
+        placeholder = PLACEHOLDER.decode('utf-8')
+        data = SAMPLES[2]
+        with self.temp_dir() as dname:
+            fname = os.path.join(dname, 'binary')
+            with open(fname, 'wb') as fh:
+                fh.write(data)
+            update_prefix(fname, '/new', placeholder, mode='binary')
+            with open(fname, 'rb') as fh:
+                self.assertEqual(fh.read(),
+                                 reference_binary_replace(data, PLACEHOLDER,
+                                                          b'/new'))
+
+
+def create_package(pkgs_dir, dist, files):
+    """
+    Create an extracted package in the package cache, with the given
+    mapping of relative path to content.
+
+    """
+    info_dir = os.path.join(pkgs_dir, dist, 'info')
+    os.makedirs(info_dir)
+    for path, content in files.items():
+        fname = os.path.join(pkgs_dir, dist, path)
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        with open(fname, 'w') as fh:
+            fh.write(content)
+    with open(os.path.join(info_dir, 'files'), 'w') as fh:
+        fh.write('\n'.join(sorted(files)) + '\n')
+    name = dist.rsplit('-', 2)[0]
+    with open(os.path.join(info_dir, 'index.json'), 'w') as fh:
+        json.dump({'name': name}, fh)
+
+
+class Test__copy_file(tests.CommonTest):
+    def setUp(self):
+        # More than one chunk of the copyfileobj fallback.
+        self.data = os.urandom(3 * 1024 * 1024 + 7)
+
+    def check(self, dname):
+        src = os.path.join(dname, 'src')
+        dst = os.path.join(dname, 'dst')
+        with open(src, 'wb') as fh:
+            fh.write(self.data)
+        os.chmod(src, 0o751)
+        os.utime(src, (1000000000, 1000000000))
+        _copy_file(src, dst)
+        with open(dst, 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+        self.assertEqual(os.stat(dst).st_mode & 0o777, 0o751)
+        self.assertEqual(int(os.stat(dst).st_mtime), 1000000000)
+
+    def test_copy(self):
+        with self.temp_dir() as dname:
+            self.check(dname)
+
+    def test_copy_without_sendfile(self):
+        error = OSError(errno.EINVAL, 'Invalid argument')
+        self.patch('os.sendfile', side_effect=error, create=True)
+        with self.temp_dir() as dname:
+            self.check(dname)
+
+    def test_existing_destination(self):
+        with self.temp_dir() as dname:
+            src = os.path.join(dname, 'src')
+            dst = os.path.join(dname, 'dst')
+            with open(src, 'wb') as fh:
+                fh.write(b'new')
+            with open(dst, 'wb') as fh:
+                fh.write(b'old')
+            # The destination may be a hard link to another package's file,
+            # so it must not be written through.
+            with self.assertRaises(OSError) as cm:
+                _copy_file(src, dst)
+            self.assertEqual(cm.exception.errno, errno.EEXIST)
+            with open(dst, 'rb') as fh:
+                self.assertEqual(fh.read(), b'old')
+
+
+class Test_compile_pyc_batch(tests.CommonTest):
+    def setUp(self):
+        self.version = '{}.{}'.format(*sys.version_info[:2])
+
+    def test_compile(self):
+        with self.temp_dir() as dname:
+            good = [os.path.join(dname, 'a.py'),
+                    os.path.join(dname, 'sub', 'b.py')]
+            bad = os.path.join(dname, 'c.py')
+            os.mkdir(os.path.join(dname, 'sub'))
+            for fname in good:
+                with open(fname, 'w') as fh:
+                    fh.write('x = 1\n')
+            with open(bad, 'w') as fh:
+                fh.write('def (\n')
+            result = compile_pyc_batch(sys.executable, good + [bad],
+                                       self.version)
+            # Only the files which compiled are reported, in order.
+            expected = [pyc_path(fname, self.version) for fname in good]
+            self.assertEqual(result, expected)
+            for fname in expected:
+                self.assertTrue(os.path.isfile(fname))
+            self.assertFalse(os.path.exists(pyc_path(bad, self.version)))
+
+    def test_nothing_to_compile(self):
+        self.assertEqual(compile_pyc_batch(sys.executable, [], self.version),
+                         [])
+
+
+def create_tarball(pkgs_dir, dist, members):
+    """
+    Create a package tarball in the package cache, with the given mapping of
+    member name to content.
+
+    """
+    fname = os.path.join(pkgs_dir, dist + '.tar.bz2')
+    with tarfile.open(fname, 'w:bz2') as tar:
+        for name, content in sorted(members.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o644
+            # Owned by someone else, which must not be restored.
+            info.uid = info.gid = 4321
+            tar.addfile(info, io.BytesIO(content))
+        info = tarfile.TarInfo('bin/link')
+        info.type = tarfile.SYMTYPE
+        info.linkname = 'tool'
+        tar.addfile(info)
+    return fname
+
+
+class Test_extract(tests.CommonTest):
+    def setUp(self):
+        self.members = {'info/files': b'bin/tool\nbin/link\nlib/big\n',
+                        'info/index.json': b'{"name": "foo"}',
+                        'bin/tool': b'#!/bin/sh\n',
+                        # Larger than a single read ahead chunk.
+                        'lib/big': os.urandom(5 * 1024 * 1024 + 3)}
+
+    def check(self, pkgs_dir):
+        path = os.path.join(pkgs_dir, 'foo-1-0')
+        for name, content in self.members.items():
+            with open(os.path.join(path, name), 'rb') as fh:
+                self.assertEqual(fh.read(), content)
+        self.assertEqual(os.readlink(os.path.join(path, 'bin', 'link')),
+                         'tool')
+        self.assertEqual(extracted(pkgs_dir), set(['foo-1-0']))
+
+    def test_extract(self):
+        mchown = self.patch('os.chown')
+        mlchown = self.patch('os.lchown', create=True)
+        with self.temp_dir() as pkgs_dir:
+            create_tarball(pkgs_dir, 'foo-1-0', self.members)
+            extract(pkgs_dir, 'foo-1-0')
+            self.check(pkgs_dir)
+        # The ownership of the members is never restored.
+        self.assertFalse(mchown.called)
+        self.assertFalse(mlchown.called)
+
+    def test_extract_old_tarfile(self):
+        # Before Python 3.8, the member content is copied by our own
+        # replacement for tarfile.copyfileobj.
+        self.patch('tarfile.copyfileobj', tarfile.copyfileobj)
+        self.patch('sys.version_info', (3, 7, 0))
+        with self.temp_dir() as pkgs_dir:
+            create_tarball(pkgs_dir, 'foo-1-0', self.members)
+            extract(pkgs_dir, 'foo-1-0')
+            self.assertIs(tarfile.copyfileobj, _tar_copyfileobj)
+            self.check(pkgs_dir)
+
+
+class Test__tar_copyfileobj(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(5 * 1024 * 1024 + 3)
+
+    def test_length(self):
+        dst = io.BytesIO()
+        _tar_copyfileobj(io.BytesIO(self.data), dst, length=len(self.data) - 3)
+        self.assertEqual(dst.getvalue(), self.data[:-3])
+
+    def test_all(self):
+        dst = io.BytesIO()
+        _tar_copyfileobj(io.BytesIO(self.data), dst)
+        self.assertEqual(dst.getvalue(), self.data)
+
+    def test_nothing(self):
+        dst = io.BytesIO()
+        _tar_copyfileobj(io.BytesIO(self.data), dst, length=0)
+        self.assertEqual(dst.getvalue(), b'')
+
+    def test_short(self):
+        with self.assertRaises(tarfile.ReadError):
+            _tar_copyfileobj(io.BytesIO(self.data), io.BytesIO(),
+                             length=len(self.data) + 1,
+                             exception=tarfile.ReadError)
+
+
+class Test__ReadAhead(unittest.TestCase):
+    def test_read(self):
+        data = os.urandom(100000)
+        reader = _ReadAhead(io.BytesIO(data), chunksize=4096, depth=2)
+        pieces = [reader.read(1000), reader.read(5000), reader.read()]
+        self.assertEqual(b''.join(pieces), data)
+        self.assertEqual([len(piece) for piece in pieces[:2]], [1000, 5000])
+        self.assertEqual(reader.read(), b'')
+        reader.close()
+
+    def test_error(self):
+        class Broken(object):
+            def read(self, size):
+                raise IOError('broken')
+        reader = _ReadAhead(Broken())
+        with self.assertRaises(IOError):
+            reader.read()
+        reader.close()
+
+    def test_close_early(self):
+        # Closing before the end must not leave the reader thread blocked
+        # on the full queue.
+        reader = _ReadAhead(io.BytesIO(b'x' * 100000), chunksize=10, depth=1)
+        self.assertEqual(reader.read(5), b'xxxxx')
+        reader.close()
+        self.assertFalse(reader._thread.is_alive())
+
+
+class Test_extracted(tests.CommonTest):
+    def test_info_added_later(self):
+        with self.temp_dir() as pkgs_dir:
+            info_dir = os.path.join(pkgs_dir, 'foo-1-0', 'info')
+            os.makedirs(info_dir)
+            self.assertEqual(extracted(pkgs_dir), set())
+            # The info files appear without the package cache directory
+            # itself being modified.
+            for fname in ['files', 'index.json']:
+                with open(os.path.join(info_dir, fname), 'w') as fh:
+                    fh.write('{}')
+            self.assertTrue(is_extracted(pkgs_dir, 'foo-1-0'))
+            self.assertEqual(extracted(pkgs_dir), set(['foo-1-0']))
+
+    def test_missing(self):
+        with self.temp_dir() as dname:
+            self.assertEqual(extracted(os.path.join(dname, 'pkgs')), set())
+
+
+class Test_linked(tests.CommonTest):
+    def test_meta_added(self):
+        with self.temp_dir() as prefix:
+            meta_dir = os.path.join(prefix, 'conda-meta')
+            os.mkdir(meta_dir)
+            self.assertEqual(linked(prefix), set())
+            with open(os.path.join(meta_dir, 'foo-1-0.json'), 'w') as fh:
+                fh.write('{}')
+            self.assertEqual(linked(prefix), set(['foo-1-0']))
+
+    def test_result_is_a_copy(self):
+        with self.temp_dir() as prefix:
+            os.mkdir(os.path.join(prefix, 'conda-meta'))
+            linked(prefix).add('bar-1-0')
+            self.assertEqual(linked(prefix), set())
+
+
+class Test_link_all(tests.CommonTest):
+    def test_last_package_wins(self):
+        dists = ['p{}-1-0'.format(i) for i in range(6)]
+        with self.temp_dir() as dname:
+            pkgs_dir = os.path.join(dname, 'pkgs')
+            prefix = os.path.join(dname, 'env')
+            os.mkdir(prefix)
+            for dist in dists:
+                create_package(pkgs_dir, dist, {'share/common': dist})
+            link_all(pkgs_dir, prefix, dists, LINK_COPY)
+            with open(os.path.join(prefix, 'share', 'common')) as fh:
+                self.assertEqual(fh.read(), dists[-1])
+            self.assertEqual(linked(prefix), set(dists))
+
+
+class Test_unlink_many(tests.CommonTest):
+    def test_empty_parents_removed(self):
+        with self.temp_dir() as dname:
+            pkgs_dir = os.path.join(dname, 'pkgs')
+            prefix = os.path.join(dname, 'env')
+            os.mkdir(prefix)
+            create_package(pkgs_dir, 'a-1-0', {'lib/a/deep/one': 'a',
+                                               'lib/shared/two': 'a'})
+            create_package(pkgs_dir, 'b-1-0', {'lib/shared/three': 'b'})
+            link_all(pkgs_dir, prefix, ['a-1-0', 'b-1-0'], LINK_COPY)
+            unlink_many(prefix, ['a-1-0'])
+            self.assertFalse(os.path.exists(os.path.join(prefix, 'lib', 'a')))
+            self.assertEqual(os.listdir(os.path.join(prefix, 'lib')),
+                             ['shared'])
+            self.assertEqual(os.listdir(os.path.join(prefix, 'lib',
+                                                     'shared')),
+                             ['three'])
+            self.assertEqual(linked(prefix), set(['b-1-0']))
+            unlink_many(prefix, ['b-1-0'])
+            # The prefix is left empty, so it goes too.
+            self.assertFalse(os.path.exists(prefix))
+
+
+class Test_messages(tests.CommonTest):
+    text = u'The package is now set up.\n' * 1000
+
+    def write_messages(self, prefix):
+        path = os.path.join(prefix, '.messages.txt')
+        with io.open(path, 'w', encoding='utf-8') as fh:
+            fh.write(self.text)
+        return path
+
+    def test_text_stdout(self):
+        # A text-only stdout, as used when driving main() in-process.
+        stdout = self.patch('sys.stdout', new=io.StringIO())
+        with self.temp_dir() as prefix:
+            path = self.write_messages(prefix)
+            messages(prefix)
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(stdout.getvalue(), self.text)
+
+    def test_fd_stdout(self):
+        with self.temp_dir() as prefix:
+            path = self.write_messages(prefix)
+            out_path = os.path.join(prefix, 'stdout')
+            with io.open(out_path, 'w', encoding='utf-8') as stdout:
+                self.patch('sys.stdout', new=stdout)
+                print(u'before')
+                messages(prefix)
+                print(u'after')
+            self.assertFalse(os.path.exists(path))
+            with io.open(out_path, encoding='utf-8') as fh:
+                self.assertEqual(fh.read(),
+                                 u'before\n' + self.text + u'after\n')
+
+    def test_write_error_keeps_file(self):
+        class Broken(io.StringIO):
+            def write(self, text):
+                raise IOError(errno.EPIPE, 'Broken pipe')
+        self.patch('sys.stdout', new=Broken())
+        with self.temp_dir() as prefix:
+            path = self.write_messages(prefix)
+            messages(prefix)
+            self.assertTrue(os.path.exists(path))
+
+    def test_no_messages(self):
+        stdout = self.patch('sys.stdout', new=io.StringIO())
+        with self.temp_dir() as prefix:
+            messages(prefix)
+        self.assertEqual(stdout.getvalue(), '')
+
+
+class Test_main(tests.CommonTest):
+    def setUp(self):
+        self.stdout = self.patch('sys.stdout', new=io.StringIO())
+        # Keep the usage errors of argparse quiet.
+        self.patch('sys.stderr', new=io.StringIO())
+
+    def test_list(self):
+        with self.temp_dir() as prefix:
+            meta_dir = os.path.join(prefix, 'conda-meta')
+            os.mkdir(meta_dir)
+            for dist in ['b-1-0', 'a-2-0']:
+                with open(os.path.join(meta_dir, dist + '.json'), 'w') as fh:
+                    fh.write('{}')
+            main(['--list', '--prefix', prefix])
+        self.assertEqual(self.stdout.getvalue(), 'a-2-0\nb-1-0\n')
+
+    def test_list_empty(self):
+        with self.temp_dir() as prefix:
+            main(['-l', '-p', prefix])
+        self.assertEqual(self.stdout.getvalue(), '')
+
+    def test_list_unexpected_argument(self):
+        with self.assertRaises(SystemExit) as cm:
+            main(['--list', 'foo-1-0'])
+        self.assertEqual(cm.exception.code, 2)
+
+    def test_link_tarball(self):
+        mlink = self.patch('conda_rpms.install.link')
+        main(['--link', '-p', '/prefix', '--pkgs-dir', '/pkgs',
+              '/path/to/foo-1-0.tar.bz2'])
+        mlink.assert_called_once_with('/pkgs', '/prefix', 'foo-1-0',
+                                      target_prefix=None)
+
+    def test_unlink_no_argument(self):
+        with self.assertRaises(SystemExit) as cm:
+            main(['--unlink'])
+        self.assertEqual(cm.exception.code, 2)
+
+    def test_logging_left_alone(self):
+        mconfig = self.patch('logging.basicConfig')
+        with self.temp_dir() as prefix:
+            main(['-l', '-p', prefix])
+        self.assertFalse(mconfig.called)
+
+
+if __name__ == '__main__':
+    unittest.main()